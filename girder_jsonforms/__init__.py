@@ -2,17 +2,31 @@
 # -*- coding: utf-8 -*-
 import json
 import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+import cherrypy
+from cherrypy.process.plugins import Monitor
 from girder import events
 from girder.constants import AccessType
 from girder.models.file import File
 from girder.models.item import Item
 from girder.models.setting import Setting
+from girder.models.user import User
 from girder.plugin import GirderPlugin, registerPluginStaticContent
 from girder.utility.model_importer import ModelImporter
 
-from .lib.google_drive import authenticate_gdrive, upload_file_to_gdrive
+from .lib.checksum import file_md5
+from .lib.google_drive import (
+    DriveFolderCache,
+    DriveUploadPool,
+    authenticate_gdrive,
+    resolve_upload_targets,
+    upload_to_folder,
+)
+from .models.drive_folder import DriveFolder as DriveFolderModel
+from .models.drive_sync import DriveSync as DriveSyncModel
 from .models.entry import FormEntry as FormEntryModel
 from .models.form import Form as FormModel
 from .rest.entry import FormEntry
@@ -20,6 +34,14 @@ from .rest.form import Form
 from .settings import PluginSettings
 
 GDRIVE_SERVICE = None
+GDRIVE_FOLDERS = None
+GDRIVE_UPLOADS = None
+# Runs lowerUniqueValue backfills one at a time, off the request and load paths.
+BACKFILLS = None
+# How often the Drive outbox is checked for due uploads (in seconds).
+GDRIVE_SYNC_INTERVAL = 5
+# How often entries left pending by a stopped process are looked for (in seconds).
+FINALIZE_RESUME_INTERVAL = 60
 logger = logging.getLogger(__name__)
 
 
@@ -42,21 +64,103 @@ def annotate_uploads(event):
         Item().setMetadata(parent, reference)
 
 
+# Entries queue their uploads in the outbox directly. These events let other
+# plugins queue uploads too.
 def upload_to_gdrive(event):
-    global GDRIVE_SERVICE
     if GDRIVE_SERVICE is None:
         logger.error("Google Drive integration is not enabled.")
         return
-    info = event.info
+    DriveSyncModel().enqueue_uploads([event.info], event.info["currentUser"])
+
+
+def upload_batch_to_gdrive(event):
+    if GDRIVE_SERVICE is None:
+        logger.error("Google Drive integration is not enabled.")
+        return
+    DriveSyncModel().enqueue_uploads(event.info["uploads"], event.info["currentUser"])
+
+
+def drain_gdrive_outbox():
+    """Claim the due uploads of the Drive outbox, as many as the pool can take."""
+    try:
+        capacity = 2 * GDRIVE_UPLOADS.workers - GDRIVE_UPLOADS.inflight
+        if capacity > 0 and (syncs := DriveSyncModel().claim(capacity)):
+            GDRIVE_UPLOADS.run(_sync_to_gdrive, syncs)
+    except Exception:
+        # An exception would stop the monitor thread.
+        logger.exception("Failed to check the Google Drive outbox")
+
+
+def resume_pending_entries():
+    """Finalize the entries whose finalizing process has stopped."""
+    try:
+        FormEntryModel().resume_pending()
+    except Exception:
+        # An exception would stop the monitor thread.
+        logger.exception("Failed to resume pending entries")
+
+
+def _sync_to_gdrive(syncs):
+    """
+    Resolve the Drive folders and existing files of claimed uploads at once per
+    root folder, then queue the uploads themselves.
+    """
+    by_root = {}
+    for sync in syncs:
+        file = File().load(sync["fileId"], force=True)
+        if file is None:
+            DriveSyncModel().complete(sync)
+            continue
+        by_root.setdefault(sync["rootId"], []).append((sync, file))
+    for root_id, claimed in by_root.items():
+        try:
+            targets = resolve_upload_targets(
+                GDRIVE_SERVICE,
+                root_id,
+                [sync["path"] for sync, _ in claimed],
+                cache=GDRIVE_FOLDERS,
+            )
+        except Exception as exc:
+            logger.exception("Failed to resolve Google Drive folders")
+            for sync, _ in claimed:
+                DriveSyncModel().fail(sync, exc)
+            continue
+        for sync, file in claimed:
+            info = {
+                "file": file,
+                "gdriveFolderId": root_id,
+                "path": sync["path"],
+                "target": targets[sync["path"]],
+                "currentUser": User().load(sync["userId"], force=True),
+            }
+            GDRIVE_UPLOADS.submit(_sync_upload, sync, info)
+
+
+def _sync_upload(sync, info):
+    try:
+        _upload_to_gdrive(info)
+    except Exception as exc:
+        DriveSyncModel().fail(sync, exc)
+        raise
+    DriveSyncModel().complete(sync)
+
+
+def _upload_to_gdrive(info):
     file = info["file"]
 
+    def checksum():
+        return file_md5(file)
+
+    parent_id, existing = info["target"]
     with File().open(file) as fh:
-        gdrive_file_id = upload_file_to_gdrive(
+        gdrive_file_id = upload_to_folder(
             GDRIVE_SERVICE,
-            info["gdriveFolderId"],
-            info["path"],
+            parent_id,
+            os.path.basename(info["path"]),
             fh,
-            mimetype=file["mimeType"],
+            file["mimeType"],
+            existing=existing,
+            checksum=checksum,
         )
     parent = Item().load(
         file["itemId"], level=AccessType.WRITE, user=info["currentUser"]
@@ -64,13 +168,52 @@ def upload_to_gdrive(event):
     Item().setMetadata(parent, {"gdriveFileId": gdrive_file_id})
 
 
+def invalidate_materialized_form(event):
+    FormModel().clear_materialized(event.info["_id"])
+
+
+def invalidate_materialized_entry(event):
+    FormModel().clear_materialized(event.info["formId"])
+
+
+def sync_entry_indexes(event):
+    FormEntryModel().sync_unique_field_indexes()
+    form = event.info
+    if form.get("indexedUniqueField") != form["uniqueField"]:
+        BACKFILLS.submit(update_lower_unique_values, form)
+
+
+def update_lower_unique_values(form):
+    try:
+        FormEntryModel().update_lower_unique_values(form)
+    except Exception:
+        logger.exception("Failed to update the search keys of form %s", form["_id"])
+
+
+def invalidate_destination_folder(event):
+    FormEntryModel().invalidate_destination_folder(event.info)
+
+
+def sync_entry_indexes_on_remove(event):
+    FormEntryModel().sync_unique_field_indexes(exclude=event.info["_id"])
+
+
 class JSONFormsPlugin(GirderPlugin):
     DISPLAY_NAME = "JSON Forms"
 
     def load(self, info):
         ModelImporter.registerModel("form", FormModel, plugin="jsonforms")
         ModelImporter.registerModel("entry", FormEntryModel, plugin="jsonforms")
-        global GDRIVE_SERVICE
+        ModelImporter.registerModel(
+            "gdrive_folder", DriveFolderModel, plugin="jsonforms"
+        )
+        ModelImporter.registerModel("gdrive_sync", DriveSyncModel, plugin="jsonforms")
+        global GDRIVE_SERVICE, GDRIVE_FOLDERS, GDRIVE_UPLOADS, BACKFILLS
+        GDRIVE_FOLDERS = DriveFolderCache(store=DriveFolderModel())
+        if BACKFILLS is None:
+            BACKFILLS = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="jsonforms-backfill"
+            )
         if Setting().get(PluginSettings.GOOGLE_DRIVE_ENABLED):
             try:
                 GDRIVE_SERVICE = authenticate_gdrive()
@@ -79,8 +222,48 @@ class JSONFormsPlugin(GirderPlugin):
         info["apiRoot"].form = Form()
         info["apiRoot"].entry = FormEntry()
         events.bind("data.process", "jsonforms", annotate_uploads)
+        events.bind("model.form.save.after", "jsonforms", invalidate_materialized_form)
+        events.bind("model.form.remove", "jsonforms", invalidate_materialized_form)
+        events.bind(
+            "model.entry.save.after", "jsonforms", invalidate_materialized_entry
+        )
+        events.bind("model.entry.remove", "jsonforms", invalidate_materialized_entry)
+        events.bind("model.form.save.after", "jsonforms.indexes", sync_entry_indexes)
+        events.bind(
+            "model.form.remove", "jsonforms.indexes", sync_entry_indexes_on_remove
+        )
+        # Girder saves folders when they are moved or renamed.
+        events.bind(
+            "model.folder.save.after", "jsonforms", invalidate_destination_folder
+        )
+        events.bind("model.folder.remove", "jsonforms", invalidate_destination_folder)
+        FormEntryModel().sync_unique_field_indexes()
+        for form in FormModel().find(
+            {}, fields=["uniqueField", "indexedUniqueField"]
+        ):
+            if form.get("indexedUniqueField") != form["uniqueField"]:
+                BACKFILLS.submit(update_lower_unique_values, form)
+        # Entries are only resumed by a running server, not by other processes
+        # loading the plugin.
+        Monitor(
+            cherrypy.engine,
+            resume_pending_entries,
+            frequency=FINALIZE_RESUME_INTERVAL,
+            name="jsonforms-finalize-resume",
+        ).subscribe()
         if GDRIVE_SERVICE is not None:
+            GDRIVE_UPLOADS = DriveUploadPool(
+                Setting().get(PluginSettings.GDRIVE_UPLOAD_WORKERS)
+            )
+            # Upload events only add to the outbox, which is drained onto the pool.
             events.bind("gdrive.upload", "jsonforms", upload_to_gdrive)
+            events.bind("gdrive.upload.batch", "jsonforms", upload_batch_to_gdrive)
+            Monitor(
+                cherrypy.engine,
+                drain_gdrive_outbox,
+                frequency=GDRIVE_SYNC_INTERVAL,
+                name="jsonforms-gdrive-sync",
+            ).subscribe()
         registerPluginStaticContent(
             plugin="jsonforms",
             css=["/style.css"],
@@ -0,0 +1,98 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Callable, Hashable
+from typing import Any
+
+
+class LRUCache:
+    """
+    A small thread-safe in-process LRU cache with hit/miss counters.
+
+    Args:
+        maxsize (int): Maximum number of entries kept before the least recently
+            used one is evicted.
+    """
+
+    _missing = object()
+
+    def __init__(self, maxsize: int = 256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def get(
+        self,
+        key: Hashable,
+        default: Any = None,
+        validate: Callable[[Any], bool] | None = None,
+    ) -> Any:
+        """
+        Return the cached value for ``key``.
+
+        If ``validate`` is given and returns False for the cached value, the entry
+        is dropped and the lookup counts as a miss.
+        """
+        with self._lock:
+            value = self._data.get(key, self._missing)
+        # Validation may hit the database, so it must not hold the lock.
+        if value is not self._missing and validate is not None and not validate(value):
+            with self._lock:
+                if self._data.get(key) is value:
+                    del self._data[key]
+            value = self._missing
+        with self._lock:
+            if value is self._missing:
+                self.misses += 1
+                return default
+            if key in self._data:
+                self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        with self._lock:
+            return self._data.pop(key, default)
+
+    def discard(self, predicate: Callable[[Hashable, Any], bool]) -> int:
+        """
+        Remove every entry for which ``predicate(key, value)`` is true.
+
+        Returns:
+            int: The number of removed entries.
+        """
+        with self._lock:
+            stale = [key for key, value in self._data.items() if predicate(key, value)]
+            for key in stale:
+                del self._data[key]
+            return len(stale)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def info(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+            }
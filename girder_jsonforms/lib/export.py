@@ -0,0 +1,152 @@
+import csv
+import datetime
+import io
+import re
+from collections.abc import Iterable, Iterator
+from typing import IO, Any
+
+from openpyxl import Workbook
+
+ARRAY_INDEX = re.compile(r"\.\[(\d+)\]")
+CELL_TYPES = (str, int, float, bool, datetime.datetime, datetime.date)
+
+
+def measure_arrays(flat: Iterable[str], lengths: dict[str, int]) -> None:
+    """
+    Record the length of every array found in a jq-style flattened entry.
+
+    Lengths are keyed by the array path in ``infer_column_types`` notation, e.g.
+    ``data.list.[3].tags.[1]`` updates ``data.list`` to 4 and
+    ``data.list[].tags`` to 2.
+
+    Args:
+        flat (iterable): The keys of a flattened entry, e.g. a dictionary returned
+            by ``convert_to_jq_notation`` or keys streamed by ``iter_jq_keys``.
+        lengths (dict): Maximum lengths seen so far, updated in place.
+    """
+    for key in flat:
+        pattern = ""
+        pos = 0
+        for match in ARRAY_INDEX.finditer(key):
+            pattern += key[pos : match.start()]
+            length = int(match.group(1)) + 1
+            if lengths.get(pattern, 0) < length:
+                lengths[pattern] = length
+            pattern += "[]"
+            pos = match.end()
+
+
+def table_columns(types: dict[str, str], lengths: dict[str, int]) -> list[str]:
+    """
+    Compute jq-style column names from inferred column types.
+
+    Args:
+        types (dict): Column types as returned by ``Form.get_data_types``.
+        lengths (dict): Maximum array lengths, as collected by ``measure_arrays``.
+
+    Returns:
+        list: Column names in schema order, with arrays expanded in place.
+    """
+    children = {}
+    for key in types:
+        parent = key[: key.rfind("[].")] if "[]." in key else None
+        children.setdefault(parent, []).append(key)
+
+    columns = []
+
+    def expand(parent, prefix):
+        for key in children.get(parent, []):
+            name = key if parent is None else f"{prefix}.{key[len(parent) + 3 :]}"
+            if types[key] != "array":
+                columns.append(name)
+                continue
+            for index in range(lengths.get(key, 0)):
+                if key in children:
+                    expand(key, f"{name}.[{index}]")
+                else:
+                    columns.append(f"{name}.[{index}]")
+
+    expand(None, "")
+    return columns
+
+
+def iter_csv(
+    columns: list[str], rows: Iterable[dict], batch_size: int = 1000
+) -> Iterator[bytes]:
+    """
+    Write rows as CSV, yielding an encoded chunk every ``batch_size`` rows.
+
+    Values for keys that are not listed in ``columns`` are dropped.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        writer.writerow([row.get(column) for column in columns])
+        if count % batch_size == 0:
+            yield buffer.getvalue().encode("utf-8")
+            buffer.seek(0)
+            buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _to_int(value):
+    return int(value) if isinstance(value, str) else value
+
+
+def _to_float(value):
+    return float(value) if isinstance(value, str) else value
+
+
+def _to_bool(value):
+    if isinstance(value, str) and value.lower() in ("true", "false"):
+        return value.lower() == "true"
+    return value
+
+
+_CASTS = {"int64": _to_int, "float64": _to_float, "bool": _to_bool}
+
+
+def to_cell(value: Any, typename: str | None = None) -> Any:
+    """
+    Convert a value to a native spreadsheet cell value of the given pandas type.
+    """
+    if value is None or value == "":
+        return None
+    if cast := _CASTS.get(typename):
+        try:
+            value = cast(value)
+        except ValueError:
+            pass
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        value = value.replace(tzinfo=None)
+    if not isinstance(value, CELL_TYPES):
+        value = str(value)
+    return value
+
+
+def write_xlsx(
+    columns: list[str],
+    types: dict[str, str],
+    rows: Iterable[dict],
+    fh: IO[bytes],
+) -> None:
+    """
+    Write rows to ``fh`` as a single sheet workbook.
+
+    The workbook is created in write-only mode, so rows are flushed to disk as
+    they are appended rather than kept in memory.
+    """
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet()
+    sheet.append(columns)
+    column_types = [types.get(ARRAY_INDEX.sub("[]", column)) for column in columns]
+    for row in rows:
+        sheet.append(
+            [
+                to_cell(row.get(column), typename)
+                for column, typename in zip(columns, column_types)
+            ]
+        )
+    workbook.save(fh)
@@ -1,149 +1,557 @@
+import datetime
+import functools
 import os
 import pickle
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 
 # from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaIoBaseUpload
+from googleapiclient.discovery import build_from_document
+from googleapiclient.discovery_cache import get_static_doc
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseUpload, build_http
+
+from .cache import LRUCache
+from .metrics import metrics
 
 logger = logging.getLogger("google_drive")
 logprint = logger
 # If modifying these scopes, delete the file token.pickle.
 SCOPES = ["https://www.googleapis.com/auth/drive"]
+# Resumable upload chunks must be multiples of 256 KiB.
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+RETRIES = 5
+RETRY_STATUSES = frozenset((429, 500, 502, 503, 504))
+# Access tokens are refreshed this long before they expire, checking this often.
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+REFRESH_INTERVAL = 60
+FOLDER_MIMETYPE = "application/vnd.google-apps.folder"
+FILE_FIELDS = "id, md5Checksum, size"
+_LOOKUP = object()
+
+_local = threading.local()
 
 
 def get_credentials():
-    """Gets valid user credentials from storage.
+    """Gets user credentials from storage.
 
-    If nothing has been stored, or if the stored credentials are invalid,
-    the OAuth2 flow is completed to obtain the new credentials.
+    The file token.pickle stores the user's access and refresh tokens, and is
+    created when the authorization flow completes for the first time. Expired
+    access tokens are refreshed in memory by ``DriveClient``, as the refresh
+    token they are obtained with does not change.
 
     Returns:
-        Credentials, the obtained credential.
+        Credentials, the stored credentials.
+
+    Raises:
+        ValueError: If there are no credentials, or they cannot be refreshed.
     """
     creds = None
-    # The file token.pickle stores the user's access and refresh tokens, and is
-    # created automatically when the authorization flow completes for the first
-    # time.
-
     path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "token.pickle")
 
     if os.path.exists(path):
         with open(path, "rb") as token:
             creds = pickle.load(token)
-    # If there are no (valid) credentials available, let the user log in.
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            raise ValueError("No valid credentials found")
-            # flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
-            # creds = flow.run_local_server(port=0)
-        # Save the credentials for the next run
-        with open(path, "wb") as token:
-            pickle.dump(creds, token)
+    if not creds or not (creds.valid or creds.refresh_token):
+        raise ValueError("No valid credentials found")
+        # flow = InstalledAppFlow.from_client_secrets_file("credentials.json", SCOPES)
+        # creds = flow.run_local_server(port=0)
     return creds
 
 
+@functools.cache
+def _discovery_document():
+    """The Drive v3 discovery document bundled with googleapiclient."""
+    return get_static_doc("drive", "v3")
+
+
+class DriveClient:
+    """
+    Drive v3 service shared by all threads of the plugin.
+
+    The service is built on first use from the bundled discovery document, so
+    creating a client needs no network. Requests run through ``execute`` and
+    ``execute_upload`` use a transport owned by the calling thread, and a
+    background thread refreshes the access token before it expires, so that
+    requests rarely have to.
+
+    Args:
+        credentials: Google OAuth2 credentials, as returned by
+            ``get_credentials``.
+    """
+
+    def __init__(self, credentials):
+        self.credentials = credentials
+        self._service = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._refresher = None
+
+    @property
+    def service(self):
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    self._service = build_from_document(
+                        _discovery_document(), credentials=self.credentials
+                    )
+                    self._refresher = threading.Thread(
+                        target=self._refresh_loop,
+                        name="jsonforms-gdrive-token",
+                        daemon=True,
+                    )
+                    self._refresher.start()
+        return self._service
+
+    def files(self):
+        return self.service.files()
+
+    def refresh(self):
+        """Refresh the access token if it expired or is about to."""
+        with self._lock:
+            expiry = self.credentials.expiry
+            if self.credentials.valid and (
+                expiry is None or expiry - datetime.datetime.utcnow() > REFRESH_MARGIN
+            ):
+                return
+            self.credentials.refresh(Request())
+        logger.info("Refreshed Google Drive access token")
+
+    def _refresh_loop(self):
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh Google Drive access token")
+            if self._stopped.wait(REFRESH_INTERVAL):
+                return
+
+    def close(self):
+        self._stopped.set()
+
+
 def authenticate_gdrive():
-    # Load credentials from a file or any other secure source
-    # Replace 'path_to_credentials.json' with the actual path to your credentials file
-    credentials = get_credentials()
-    return build("drive", "v3", credentials=credentials)
+    """Return a ``DriveClient`` for the stored credentials."""
+    return DriveClient(get_credentials())
+
+
+def with_backoff(call, retries=RETRIES, base_delay=1.0, max_delay=32.0, sleep=None):
+    """
+    Call ``call`` until it succeeds, retrying rate limited (429) and failed (5xx)
+    requests, as well as dropped connections, with exponential backoff and full
+    jitter.
+    """
+    for attempt in range(retries + 1):
+        try:
+            return call()
+        except HttpError as exc:
+            if exc.resp.status not in RETRY_STATUSES or attempt == retries:
+                raise
+            reason = exc.resp.status
+        except (ConnectionError, TimeoutError) as exc:
+            if attempt == retries:
+                raise
+            reason = exc
+        delay = random.uniform(0, min(max_delay, base_delay * 2**attempt))
+        logger.warning("Drive request failed (%s), retrying in %.1fs", reason, delay)
+        (sleep or time.sleep)(delay)
+
+
+def _thread_http(request):
+    """
+    Return an authorized transport owned by the calling thread, as httplib2 is
+    not thread safe, or None for requests that carry no credentials.
+    """
+    credentials = getattr(getattr(request, "http", None), "credentials", None)
+    if credentials is None:
+        return None
+    transports = _local.__dict__.setdefault("transports", {})
+    if (http := transports.get(id(credentials))) is None:
+        http = transports[id(credentials)] = AuthorizedHttp(
+            credentials, http=build_http()
+        )
+    return http
+
+
+def execute(request):
+    """Execute a Drive API request on this thread's transport, with retries."""
+    http = _thread_http(request)
+    kwargs = {"http": http} if http is not None else {}
+    return with_backoff(lambda: request.execute(**kwargs))
+
+
+def execute_upload(request):
+    """Send a resumable upload chunk by chunk, retrying each chunk."""
+    http = _thread_http(request)
+    kwargs = {"http": http} if http is not None else {}
+    response = None
+    while response is None:
+        _, response = with_backoff(lambda: request.next_chunk(**kwargs))
+    return response
+
+
+class DriveUploadPool:
+    """
+    Run Drive uploads on a bounded thread pool.
+
+    Queue depth, active and finished uploads and time spent uploading are
+    reported in ``metrics`` under ``gdrive.uploads.*`` and ``gdrive.upload.*``.
+    ``gdrive.upload.ms`` sums the time of every upload, while
+    ``gdrive.upload.busyMs`` is the wall time during which any upload ran.
+
+    Args:
+        workers (int): Number of concurrent uploads.
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="jsonforms-gdrive"
+        )
+        self._inflight = 0
+        self._active = 0
+        self._busy_since = None
+        self._lock = threading.Lock()
+
+    @property
+    def inflight(self):
+        """Number of uploads and tasks queued or running."""
+        with self._lock:
+            return self._inflight
+
+    def _track(self, amount):
+        with self._lock:
+            self._inflight += amount
+
+    def submit(self, upload, *args):
+        """Queue ``upload(*args)``."""
+        metrics.incr("gdrive.uploads.queued")
+        self._track(1)
+        return self._executor.submit(self._run, upload, args)
+
+    def _run(self, upload, args):
+        try:
+            return self._upload(upload, args)
+        finally:
+            self._track(-1)
+
+    def _busy(self, amount):
+        """Count active uploads, and the wall time while there are any."""
+        with self._lock:
+            self._active += amount
+            if amount > 0 and self._active == 1:
+                self._busy_since = time.monotonic()
+            elif not self._active:
+                busy = time.monotonic() - self._busy_since
+                metrics.incr("gdrive.upload.busyMs", int(busy * 1000))
+
+    def _upload(self, upload, args):
+        metrics.incr("gdrive.uploads.queued", -1)
+        metrics.incr("gdrive.uploads.active")
+        self._busy(1)
+        start = time.monotonic()
+        try:
+            result = upload(*args)
+        except Exception:
+            metrics.incr("gdrive.uploads.failed")
+            logger.exception("Google Drive upload failed")
+            return None
+        finally:
+            metrics.incr("gdrive.uploads.active", -1)
+            metrics.incr("gdrive.upload.ms", int((time.monotonic() - start) * 1000))
+            self._busy(-1)
+        metrics.incr("gdrive.uploads.completed")
+        return result
+
+    def run(self, task, *args):
+        """Run ``task(*args)``, which is not an upload itself, on the pool."""
+        self._track(1)
+        return self._executor.submit(self._run_task, task, args)
+
+    def _run_task(self, task, args):
+        try:
+            return task(*args)
+        except Exception:
+            logger.exception("Google Drive task failed")
+            return None
+        finally:
+            self._track(-1)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class DriveFolderCache:
+    """
+    Map (root folder ID, relative path) to the ID of a Drive folder.
+
+    An in-process LRU sits in front of an optional persistent ``store``, which
+    must provide ``lookup(root_id, path)``, ``record(root_id, path, folder_id)``
+    and ``forget(root_id, path)``. Paths are "/" separated, without leading or
+    trailing separators.
+
+    Args:
+        store: Persistent mapping shared between processes, or None.
+        maxsize (int): Maximum number of paths kept in memory.
+    """
 
+    def __init__(self, store=None, maxsize=1024):
+        self.store = store
+        self._lru = LRUCache(maxsize=maxsize)
 
-def create_folders(service, folder_id, path):
+    def get(self, root_id, path):
+        folder_id = self._lru.get((root_id, path))
+        if folder_id is None and self.store is not None:
+            folder_id = self.store.lookup(root_id, path)
+            if folder_id is not None:
+                self._lru.set((root_id, path), folder_id)
+        return folder_id
+
+    def set(self, root_id, path, folder_id):
+        self._lru.set((root_id, path), folder_id)
+        if self.store is not None:
+            self.store.record(root_id, path, folder_id)
+
+    def invalidate(self, root_id, path):
+        """Forget ``path`` and every path below it."""
+        self._lru.discard(
+            lambda key, _: key[0] == root_id
+            and (key[1] == path or key[1].startswith(path + "/"))
+        )
+        if self.store is not None:
+            self.store.forget(root_id, path)
+
+
+def create_folders(service, folder_id, path, cache=None):
     if service is None:
         logger.exception("Service not initialized. Failed to create folder.")
         return
-    current_folder_id = folder_id
-    folders = path.split("/")
-    for folder in folders:
-        if folder:
-            # Check if folder already exists
-            query = f"'{current_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and name='{folder}' and trashed=false"
-            response = (
-                service.files()
-                .list(
-                    q=query,
-                    fields="files(id)",
-                    includeItemsFromAllDrives=True,
-                    supportsAllDrives=True,
-                )
-                .execute()
+    folders = [folder for folder in path.split("/") if folder]
+    current_folder_id, start = folder_id, 0
+    if cache is not None:
+        # Only the folders below the longest cached prefix are looked up.
+        for depth in range(len(folders), 0, -1):
+            if cached := cache.get(folder_id, "/".join(folders[:depth])):
+                current_folder_id, start = cached, depth
+                break
+
+    for depth in range(start, len(folders)):
+        folder = folders[depth]
+        # Check if folder already exists
+        query = f"'{current_folder_id}' in parents and mimeType='application/vnd.google-apps.folder' and name='{folder}' and trashed=false"
+        response = execute(
+            service.files().list(
+                q=query,
+                fields="files(id)",
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
             )
-            existing_folders = response.get("files", [])
-            if existing_folders:
-                logprint.error(f"Folder '{folder}' already exists")
-                logprint.error(response)
-                current_folder_id = existing_folders[0]["id"]
-            else:
-                logprint.error(f"Creating folder '{folder}'")
-                file_metadata = {
-                    "name": folder,
-                    "mimeType": "application/vnd.google-apps.folder",
-                    "parents": [current_folder_id],
-                }
-                folder_result = (
-                    service.files()
-                    .create(body=file_metadata, fields="id", supportsAllDrives=True)
-                    .execute()
-                )
-                logprint.error(
-                    f"Folder '{folder}' created with ID: {folder_result['id']}"
+        )
+        existing_folders = response.get("files", [])
+        if existing_folders:
+            logprint.error(f"Folder '{folder}' already exists")
+            logprint.error(response)
+            current_folder_id = existing_folders[0]["id"]
+        else:
+            logprint.error(f"Creating folder '{folder}'")
+            file_metadata = {
+                "name": folder,
+                "mimeType": "application/vnd.google-apps.folder",
+                "parents": [current_folder_id],
+            }
+            folder_result = execute(
+                service.files().create(
+                    body=file_metadata, fields="id", supportsAllDrives=True
                 )
-                current_folder_id = folder_result["id"]
+            )
+            logprint.error(f"Folder '{folder}' created with ID: {folder_result['id']}")
+            current_folder_id = folder_result["id"]
+        if cache is not None:
+            cache.set(folder_id, "/".join(folders[: depth + 1]), current_folder_id)
 
     return current_folder_id
 
 
-def upload_file_to_gdrive(service, folder_id, path, file_handle, mimetype="text/plain"):
+def _top_folders(paths):
+    return {folder for path in paths for folder in path.split("/")[:1] if folder}
+
+
+def _revalidating(service, folder_id, paths, cache, call):
+    """
+    Run ``call``, and if it fails because a cached Drive folder no longer exists,
+    drop everything cached below the top level folders of ``paths`` and run it
+    once more. Any folder along a path may be gone, hence the top level.
+    """
+    try:
+        return call()
+    except HttpError as exc:
+        tops = _top_folders(paths)
+        if cache is None or not tops or exc.resp.status != 404:
+            raise
+        logger.warning("Cached Drive folders below %s no longer exist", sorted(tops))
+        for top in tops:
+            cache.invalidate(folder_id, top)
+        return call()
+
+
+def list_folder_files(service, folder_id):
+    """
+    Return the files in a Drive folder, with their ID, MD5 checksum and size, by
+    name, one page at a time.
+    """
+    files, page_token = {}, None
+    while True:
+        response = execute(
+            service.files().list(
+                q=f"'{folder_id}' in parents and mimeType!='{FOLDER_MIMETYPE}' "
+                "and trashed=false",
+                fields=f"nextPageToken, files({FILE_FIELDS}, name)",
+                pageSize=1000,
+                pageToken=page_token,
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+            )
+        )
+        for file in response.get("files", []):
+            files.setdefault(file["name"], file)
+        if not (page_token := response.get("nextPageToken")):
+            return files
+
+
+def resolve_upload_targets(service, folder_id, paths, cache=None):
+    """
+    Resolve where each of ``paths`` below ``folder_id`` is uploaded, creating
+    missing folders. Each target folder is looked up and listed once.
+
+    Returns:
+        dict: ``(parent folder ID, existing file or None)`` by path, where files
+        are as returned by ``list_folder_files``.
+    """
+
+    def resolve():
+        folders = {
+            directory: create_folders(service, folder_id, directory, cache=cache)
+            for directory in {os.path.split(path)[0] for path in paths}
+        }
+        existing = {
+            target: list_folder_files(service, target)
+            for target in set(folders.values())
+        }
+        targets = {}
+        for path in paths:
+            directory, name = os.path.split(path)
+            parent_id = folders[directory]
+            targets[path] = parent_id, existing[parent_id].get(name)
+        return targets
+
+    return _revalidating(service, folder_id, paths, cache, resolve)
+
+
+def upload_file_to_gdrive(
+    service,
+    folder_id,
+    path,
+    file_handle,
+    mimetype="text/plain",
+    cache=None,
+    checksum=None,
+):
     if service is None:
         logger.exception("Service not initialized. Failed to upload file.")
         return
     file_path, file_name = os.path.split(path)
-    folder_id = create_folders(service, folder_id, file_path)
+
+    def upload():
+        file_handle.seek(0)
+        target_id = create_folders(service, folder_id, file_path, cache=cache)
+        return upload_to_folder(
+            service, target_id, file_name, file_handle, mimetype, checksum=checksum
+        )
+
+    return _revalidating(service, folder_id, [file_path], cache, upload)
+
+
+def _unchanged(existing, checksum, size):
+    """Whether the Drive file ``existing`` holds content of this MD5 and size."""
+    return (
+        existing.get("md5Checksum") is not None
+        and int(existing.get("size", -1)) == size
+        and existing["md5Checksum"] == checksum()
+    )
+
+
+def upload_to_folder(
+    service,
+    folder_id,
+    file_name,
+    file_handle,
+    mimetype,
+    existing=_LOOKUP,
+    checksum=None,
+):
+    """
+    Upload a file into a Drive folder, replacing the content of the ``existing``
+    Drive file, or creating a new file if it is None. By default the folder is
+    searched for a file with the same name.
+
+    If ``checksum`` is given, it is called for the MD5 of the content when there
+    is an existing file of the same size, and the upload is skipped if the
+    checksums match. Skipped uploads and the bytes they saved are reported in
+    ``metrics`` as ``gdrive.uploads.skipped`` and ``gdrive.upload.bytesSaved``.
+    """
     logprint.error(f"Uploading file '{file_name}' to folder '{folder_id}'")
 
-    # Check if file already exists in the folder
-    query = f"'{folder_id}' in parents and name='{file_name}' and trashed=false"
-    response = (
-        service.files()
-        .list(
-            q=query,
-            fields="files(id)",
-            includeItemsFromAllDrives=True,
-            supportsAllDrives=True,
+    if existing is _LOOKUP:
+        # Check if file already exists in the folder
+        query = f"'{folder_id}' in parents and name='{file_name}' and trashed=false"
+        response = execute(
+            service.files().list(
+                q=query,
+                fields=f"files({FILE_FIELDS})",
+                includeItemsFromAllDrives=True,
+                supportsAllDrives=True,
+            )
         )
-        .execute()
+        existing_files = response.get("files", [])
+        existing = existing_files[0] if existing_files else None
+    # Resumable uploads stream the file in chunks, and a failed chunk is resent
+    # without starting over.
+    media = MediaIoBaseUpload(
+        file_handle, mimetype=mimetype, chunksize=UPLOAD_CHUNK_SIZE, resumable=True
     )
-    existing_files = response.get("files", [])
-    media = MediaIoBaseUpload(file_handle, mimetype=mimetype)
-    if existing_files:
-        file_id = existing_files[0]["id"]
-        file_result = (
-            service.files()
-            .update(fileId=file_id, media_body=media, supportsAllDrives=True)
-            .execute()
+    size = media.size()
+    if existing and checksum is not None and _unchanged(existing, checksum, size):
+        logprint.info(f"File {file_name} is unchanged on Google Drive")
+        metrics.incr("gdrive.uploads.skipped")
+        metrics.incr("gdrive.upload.bytesSaved", size)
+        return existing["id"]
+    if existing:
+        file_result = execute_upload(
+            service.files().update(
+                fileId=existing["id"], media_body=media, supportsAllDrives=True
+            )
         )
         logprint.error(f'File {file_name} updated with ID: {file_result["id"]}')
     else:
         file_metadata = {"name": file_name, "parents": [folder_id]}
-        file_result = (
-            service.files()
-            .create(
+        file_result = execute_upload(
+            service.files().create(
                 body=file_metadata,
                 media_body=media,
                 fields="id",
                 supportsAllDrives=True,
             )
-            .execute()
         )
         logprint.error(
             f'File {file_metadata["name"]} uploaded with ID: {file_result["id"]}'
         )
+    metrics.incr("gdrive.upload.bytes", size)
     return file_result["id"]
 
 
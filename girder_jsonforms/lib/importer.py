@@ -0,0 +1,106 @@
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import IO
+
+import jsonschema
+
+
+class RawStream(io.RawIOBase):
+    """
+    Expose any object with a ``read(size)`` method as a raw binary stream.
+
+    Wrapping it in ``io.BufferedReader`` lets parsers such as ``pandas.read_csv``
+    consume a request body incrementally instead of from a copy held in memory.
+    """
+
+    def __init__(self, stream: IO[bytes]):
+        self._stream = stream
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        data = self._stream.read(len(buffer))
+        size = len(data)
+        buffer[:size] = data
+        return size
+
+
+def buffered(stream: IO[bytes], buffer_size: int = 1024 * 1024) -> io.BufferedReader:
+    return io.BufferedReader(RawStream(stream), buffer_size=buffer_size)
+
+
+_worker_validator = None
+
+
+def _init_worker(schema: dict) -> None:
+    global _worker_validator
+    _worker_validator = jsonschema.Draft7Validator(schema)
+
+
+def _validate_in_worker(rows: list[dict]) -> list[str | None]:
+    return [validation_error(_worker_validator, data) for data in rows]
+
+
+def validation_error(validator: jsonschema.Draft7Validator, data: dict) -> str | None:
+    """Return the most relevant validation error message, or None if valid."""
+    error = jsonschema.exceptions.best_match(validator.iter_errors(data))
+    return error.message if error is not None else None
+
+
+class RowValidator:
+    """
+    Validate rows against a schema, on a process pool for large batches.
+
+    The schema is sent to each worker once, when the pool starts, and compiled
+    there. Batches smaller than ``min_parallel_rows``, or any batch when
+    ``workers`` is lower than 2, are validated in the calling process. The pool
+    is only started once a batch is large enough to need it.
+
+    Args:
+        schema (dict): The JSON schema rows are validated against.
+        workers (int): Number of worker processes.
+        min_parallel_rows (int): Smallest batch validated on the pool.
+    """
+
+    def __init__(self, schema: dict, workers: int = 0, min_parallel_rows: int = 500):
+        self.schema = schema
+        self.validator = jsonschema.Draft7Validator(schema)
+        self.workers = workers
+        self.min_parallel_rows = min_parallel_rows
+        self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def validate(self, rows: list[dict]) -> list[str | None]:
+        """
+        Returns:
+            list: An error message or None for every row, in order.
+        """
+        if self.workers < 2 or len(rows) < self.min_parallel_rows:
+            return [validation_error(self.validator, data) for data in rows]
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(self.schema,),
+            )
+        size = -(-len(rows) // self.workers)
+        chunks = [rows[start : start + size] for start in range(0, len(rows), size)]
+        return [
+            error
+            for errors in self._pool.map(_validate_in_worker, chunks)
+            for error in errors
+        ]
+
+    def close(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
@@ -1,3 +1,4 @@
+from collections.abc import Iterator
 from typing import Any
 
 # find all occurences of a key in a nested json
@@ -46,32 +47,71 @@ def set_value(json_data: dict, key: str, value: Any) -> None:
     json_data[path] = value
 
 
+def _children(data: dict | list) -> Iterator[tuple[Any, Any]]:
+    if isinstance(data, dict):
+        return iter(data.items())
+    return ((f"[{index}]", value) for index, value in enumerate(data))
+
+
+def _prefix(key: str, data: dict | list, sep: str) -> str:
+    # Top level dictionary keys have no leading separator, list indices do.
+    return f"{key}{sep}" if key or isinstance(data, list) else ""
+
+
+def iter_jq_notation(
+    data: Any, parent_key: str = "", sep: str = "."
+) -> Iterator[tuple[str, Any]]:
+    """
+    Yield the leaves of a nested dictionary or list as ``(key, value)`` pairs
+    with jq-style keys, depth first.
+
+    Nesting is walked with an explicit stack rather than recursion, so depth is
+    not limited by the recursion limit, and the key prefix of each dictionary or
+    list is built once and shared by all of its children. Empty dictionaries and
+    lists yield nothing.
+
+    Args:
+        data (dict or list): The nested dictionary or list to flatten.
+        parent_key (str): A key to prefix every key with.
+        sep (str): The separator to use for keys (default is ".").
+    """
+    if not isinstance(data, dict | list):
+        yield parent_key, data
+        return
+
+    stack = [(_children(data), _prefix(parent_key, data, sep))]
+    while stack:
+        children, prefix = stack[-1]
+        for key, value in children:
+            key = f"{prefix}{key}" if prefix else key
+            if not isinstance(value, dict | list):
+                yield key, value
+            elif value:
+                stack.append((_children(value), _prefix(key, value, sep)))
+                break
+        else:
+            stack.pop()
+
+
+def iter_jq_keys(data: Any, parent_key: str = "", sep: str = ".") -> Iterator[str]:
+    """Yield the jq-style keys of the leaves of ``data``, as ``iter_jq_notation``."""
+    for key, _ in iter_jq_notation(data, parent_key, sep):
+        yield key
+
+
 def convert_to_jq_notation(data: dict, parent_key: str = "", sep: str = ".") -> dict:
     """
     Convert a nested dictionary or list into a flat dictionary with jq-style keys.
 
     Args:
         data (dict or list): The nested dictionary or list to flatten.
-        parent_key (str): The base key for recursion (used internally).
+        parent_key (str): A key to prefix every key with.
         sep (str): The separator to use for keys (default is ".").
 
     Returns:
         dict: A flattened dictionary with jq-like notation keys.
     """
-    items = []
-
-    if isinstance(data, dict):
-        for key, value in data.items():
-            new_key = f"{parent_key}{sep}{key}" if parent_key else key
-            items.extend(convert_to_jq_notation(value, new_key, sep).items())
-    elif isinstance(data, list):
-        for index, value in enumerate(data):
-            new_key = f"{parent_key}{sep}[{index}]"
-            items.extend(convert_to_jq_notation(value, new_key, sep).items())
-    else:
-        items.append((parent_key, data))
-
-    return dict(items)
+    return dict(iter_jq_notation(data, parent_key, sep))
 
 
 def parse_jq_notation(input_dict: dict) -> dict:
@@ -0,0 +1,104 @@
+import base64
+import datetime
+
+from bson import json_util
+from girder.api.rest import setResponseHeader
+from girder.exceptions import RestException
+
+from .jq import get_value
+
+NEXT_PAGE_HEADER = "Girder-Next-Page"
+_JSON_OPTIONS = json_util.JSONOptions(tz_aware=True, tzinfo=datetime.timezone.utc)
+
+
+class InvalidPageToken(ValueError):
+    pass
+
+
+def _sort_field(sort: list[tuple[str, int]]) -> tuple[str, int]:
+    if not sort or len(sort) > 2 or (len(sort) == 2 and sort[1][0] != "_id"):
+        raise InvalidPageToken("Keyset pagination requires a single sort field.")
+    return tuple(sort[0])
+
+
+def _lookup(doc: dict, field: str):
+    try:
+        return get_value(doc, field)
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def keyset_sort(sort: list[tuple[str, int]]) -> list[tuple[str, int]]:
+    """
+    Extend a single field sort with ``_id`` as a tie breaker, so that the order
+    of documents with equal sort values is stable between pages.
+    """
+    field, direction = _sort_field(sort)
+    if field == "_id":
+        return [(field, direction)]
+    return [(field, direction), ("_id", direction)]
+
+
+def encode_token(doc: dict, sort: list[tuple[str, int]]) -> str:
+    """
+    Encode the position of ``doc`` in a listing sorted by ``sort`` as an opaque
+    URL-safe token.
+    """
+    field, _ = _sort_field(sort)
+    payload = {"f": field, "v": _lookup(doc, field), "id": doc["_id"]}
+    return base64.urlsafe_b64encode(json_util.dumps(payload).encode()).decode()
+
+
+def keyset_query(token: str, sort: list[tuple[str, int]]) -> dict:
+    """
+    Build a query matching the documents that follow the position encoded in
+    ``token``, for the same sort order.
+    """
+    field, direction = _sort_field(sort)
+    try:
+        payload = json_util.loads(
+            base64.urlsafe_b64decode(token.encode()), json_options=_JSON_OPTIONS
+        )
+    except (ValueError, TypeError) as exc:
+        raise InvalidPageToken("Invalid page token.") from exc
+    if not isinstance(payload, dict) or payload.get("f") != field:
+        raise InvalidPageToken("Page token does not match the sort field.")
+
+    after = "$gt" if direction > 0 else "$lt"
+    if field == "_id":
+        return {"_id": {after: payload["id"]}}
+
+    value = payload["v"]
+    following_ties = {field: value, "_id": {after: payload["id"]}}
+    if value is None:
+        # Missing values sort before anything else, and cannot be compared to
+        # other types with $gt/$lt.
+        if direction > 0:
+            return {"$or": [following_ties, {field: {"$ne": None}}]}
+        return following_ties
+    following = {field: {after: value}}
+    if direction < 0:
+        following = {"$or": [following, {field: None}]}
+    return {"$or": [following, following_ties]}
+
+
+def keyset_params(after: str | None, sort: list[tuple[str, int]], offset: int):
+    """
+    Return the query clause, sort and offset of the page following ``after``.
+
+    Without a token the offset is kept, so that offset paging keeps working, but
+    the sort still gets its ``_id`` tie breaker.
+    """
+    try:
+        sort = keyset_sort(sort)
+        if after is None:
+            return {}, sort, offset
+        return keyset_query(after, sort), sort, 0
+    except InvalidPageToken as exc:
+        raise RestException(str(exc)) from exc
+
+
+def set_next_page_header(docs: list[dict], sort: list[tuple[str, int]], limit: int):
+    """Advertise the token of the next page if the current one is full."""
+    if limit and len(docs) == limit:
+        setResponseHeader(NEXT_PAGE_HEADER, encode_token(docs[-1], sort))
@@ -0,0 +1,118 @@
+import ast
+import logging
+from collections.abc import Callable
+
+from .cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+# Functions and string methods a path template may call.
+HELPERS = {"ord": ord, "chr": chr, "str": str, "int": int, "len": len}
+STRING_METHODS = frozenset(("lower", "upper", "strip", "title", "zfill", "replace"))
+
+_OPERATORS = (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod, ast.USub)
+_compiled = LRUCache(maxsize=256)
+
+
+class PathTemplateError(ValueError):
+    pass
+
+
+def _check(node: ast.AST) -> None:
+    """Reject anything but data lookups, constants, arithmetic and helpers."""
+    if isinstance(node, ast.Name):
+        if node.id != "data" and node.id not in HELPERS:
+            raise PathTemplateError(f"Unknown name '{node.id}' in path template.")
+    elif isinstance(node, ast.Call):
+        func = node.func
+        if isinstance(func, ast.Name) and func.id in HELPERS:
+            pass
+        elif isinstance(func, ast.Attribute) and func.attr in STRING_METHODS:
+            _check(func.value)
+        else:
+            raise PathTemplateError(
+                "Path templates may only call "
+                + ", ".join(
+                    sorted(HELPERS) + [f".{name}()" for name in sorted(STRING_METHODS)]
+                )
+                + "."
+            )
+        if node.keywords:
+            raise PathTemplateError(
+                "Keyword arguments are not allowed in path templates."
+            )
+        for arg in node.args:
+            _check(arg)
+    elif isinstance(node, ast.Attribute):
+        raise PathTemplateError(
+            f"Attribute '{node.attr}' is not allowed in path templates."
+        )
+    elif isinstance(node, (ast.BinOp, ast.UnaryOp)):
+        if not isinstance(node.op, _OPERATORS):
+            raise PathTemplateError("Unsupported operator in path template.")
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, ast.operator | ast.unaryop):
+                _check(child)
+    elif isinstance(
+        node,
+        ast.Expression | ast.JoinedStr | ast.FormattedValue | ast.Subscript | ast.Slice,
+    ):
+        for child in ast.iter_child_nodes(node):
+            if not isinstance(child, ast.expr_context):
+                _check(child)
+    elif not isinstance(node, ast.Constant):
+        raise PathTemplateError(
+            f"{type(node).__name__} expressions are not allowed in path templates."
+        )
+
+
+def compile_path_template(template: str) -> Callable[[dict], str]:
+    """
+    Compile a form's ``pathTemplate`` into a function rendering it for the data
+    of an entry.
+
+    The template is the body of a Python f-string, e.g.
+    ``{data['sampleId'][:4]}/{data['sampleId']}``. Expressions may only look up
+    ``data`` and call the helpers in ``HELPERS`` and ``STRING_METHODS``. Compiled
+    templates are cached by their source.
+
+    Raises:
+        PathTemplateError: If the template is invalid or uses anything else.
+    """
+    render = _compiled.get(template)
+    if render is not None:
+        return render
+
+    source = f'f"{template}"'
+    try:
+        tree = ast.parse(source, mode="eval")
+    except SyntaxError as exc:
+        raise PathTemplateError(f"Invalid path template: {exc.msg}.") from exc
+    _check(tree)
+    code = compile(tree, "<pathTemplate>", "eval")
+    scope = {"__builtins__": {}, **HELPERS}
+
+    def render(data: dict) -> str:
+        return eval(code, scope, {"data": data})
+
+    _compiled.set(template, render)
+    return render
+
+
+def render_path_template(template: str, data: dict) -> str | None:
+    """
+    Render ``template`` for ``data``, or return None if the data does not fit.
+
+    Templates saved before they were restricted may no longer compile; these are
+    logged and also render as None.
+    """
+    try:
+        render = compile_path_template(template)
+    except PathTemplateError:
+        logger.warning("Invalid path template %r", template, exc_info=True)
+        return None
+    try:
+        return render(data)
+    except (LookupError, TypeError, ValueError, ArithmeticError, AttributeError):
+        logger.warning("Failed to render path template %r", template, exc_info=True)
+        return None
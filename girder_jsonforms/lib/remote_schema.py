@@ -0,0 +1,119 @@
+import hashlib
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RemoteDocument:
+    """A fetched remote schema together with its HTTP validators."""
+
+    content: bytes
+    version: str
+    etag: str | None = None
+    last_modified: str | None = None
+    fetched: float = field(default_factory=time.monotonic)
+
+    def age(self) -> float:
+        return time.monotonic() - self.fetched
+
+
+class RemoteSchemaCache:
+    """
+    Fetch remote schemas over a pooled session and keep them per URL.
+
+    A document younger than ``ttl`` seconds is served from memory. Up to
+    ``stale_ttl`` seconds past that it is still served, while a conditional GET
+    revalidates it in the background. Older documents are revalidated before
+    being returned. If revalidation fails, the last known copy is served.
+
+    Args:
+        pool_size (int): Maximum number of kept-alive connections per host.
+    """
+
+    def __init__(self, pool_size: int = 10):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._documents = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def fetch(
+        self, url: str, ttl: float = 300, stale_ttl: float = 3600, timeout: float = 10
+    ) -> RemoteDocument:
+        with self._lock:
+            document = self._documents.get(url)
+        if document is None:
+            return self._revalidate(url, None, timeout)
+
+        age = document.age()
+        if age < ttl:
+            return document
+        if age < ttl + stale_ttl:
+            self._revalidate_in_background(url, document, timeout)
+            return document
+        try:
+            return self._revalidate(url, document, timeout)
+        except requests.RequestException:
+            logger.exception("Failed to revalidate %s, serving stale copy", url)
+            return document
+
+    def invalidate(self, url: str | None = None) -> None:
+        with self._lock:
+            if url is None:
+                self._documents.clear()
+            else:
+                self._documents.pop(url, None)
+
+    def _revalidate(self, url, document, timeout):
+        headers = {}
+        if document is not None:
+            if document.etag:
+                headers["If-None-Match"] = document.etag
+            if document.last_modified:
+                headers["If-Modified-Since"] = document.last_modified
+
+        response = self.session.get(url, headers=headers, timeout=timeout)
+        if response.status_code == 304 and document is not None:
+            document.fetched = time.monotonic()
+            return document
+        response.raise_for_status()
+
+        content = response.content
+        document = RemoteDocument(
+            content=content,
+            version=hashlib.sha256(content).hexdigest(),
+            etag=response.headers.get("ETag"),
+            last_modified=response.headers.get("Last-Modified"),
+        )
+        with self._lock:
+            self._documents[url] = document
+        return document
+
+    def _revalidate_in_background(self, url, document, timeout):
+        with self._lock:
+            if url in self._refreshing:
+                return
+            self._refreshing.add(url)
+
+        def refresh():
+            try:
+                self._revalidate(url, document, timeout)
+            except requests.RequestException:
+                logger.exception("Background revalidation of %s failed", url)
+            finally:
+                with self._lock:
+                    self._refreshing.discard(url)
+
+        threading.Thread(target=refresh, daemon=True).start()
+
+
+remote_schemas = RemoteSchemaCache()
@@ -0,0 +1,45 @@
+import datetime
+import re
+
+from girder.models.model_base import Model
+
+
+class DriveFolder(Model):
+    """
+    Persistent mapping of (Drive root folder ID, relative path) to the ID of the
+    Drive folder at that path, backing ``lib.google_drive.DriveFolderCache``.
+    """
+
+    def initialize(self):
+        self.name = "gdrive_folder"
+        self.ensureIndices([([("rootId", 1), ("path", 1)], {"unique": True})])
+
+    def validate(self, doc):
+        return doc
+
+    def lookup(self, root_id, path):
+        doc = self.findOne({"rootId": root_id, "path": path}, fields=["folderId"])
+        return doc["folderId"] if doc else None
+
+    def record(self, root_id, path, folder_id):
+        self.collection.update_one(
+            {"rootId": root_id, "path": path},
+            {
+                "$set": {
+                    "folderId": folder_id,
+                    "updated": datetime.datetime.utcnow(),
+                }
+            },
+            upsert=True,
+        )
+
+    def forget(self, root_id, path):
+        self.collection.delete_many(
+            {
+                "rootId": root_id,
+                "$or": [
+                    {"path": path},
+                    {"path": {"$regex": "^" + re.escape(path + "/")}},
+                ],
+            }
+        )
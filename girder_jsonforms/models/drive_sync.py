@@ -0,0 +1,138 @@
+import datetime
+
+from girder.models.model_base import Model
+from girder.models.setting import Setting
+from pymongo import ASCENDING, ReturnDocument
+
+from ..settings import PluginSettings
+
+SYNC_PENDING = "pending"
+SYNC_FAILED = "failed"
+
+# Attempts before an upload is marked as failed, and how long a claimed upload
+# is reserved for the process that claimed it.
+MAX_ATTEMPTS = 5
+LEASE = datetime.timedelta(minutes=15)
+
+
+class DriveSync(Model):
+    """
+    Outbox of pending Google Drive uploads, one document per Girder file and
+    Drive target (root folder ID and path below it).
+
+    Queuing an upload that is already pending pushes it back by the debounce
+    delay instead of adding another one, so a burst of writes to the same file
+    results in a single upload of its latest content. Claimed uploads are leased
+    rather than removed, so uploads interrupted by a restart are picked up again
+    once their lease expires.
+    """
+
+    def initialize(self):
+        self.name = "gdrive_sync"
+        self.ensureIndices(
+            [
+                (
+                    [("fileId", ASCENDING), ("rootId", ASCENDING), ("path", ASCENDING)],
+                    {"unique": True},
+                ),
+                ([("status", ASCENDING), ("dueAt", ASCENDING)], {}),
+            ]
+        )
+
+    def validate(self, doc):
+        return doc
+
+    def enqueue(self, file, root_id, path, user, delay=0):
+        """Queue an upload of ``file`` to ``path`` below ``root_id``."""
+        now = datetime.datetime.utcnow()
+        self.collection.update_one(
+            {"fileId": file["_id"], "rootId": root_id, "path": path},
+            {
+                "$set": {
+                    "status": SYNC_PENDING,
+                    "dueAt": now + datetime.timedelta(seconds=delay),
+                    "userId": user["_id"] if user else None,
+                    "attempts": 0,
+                    "error": None,
+                    "updated": now,
+                },
+                "$inc": {"version": 1},
+                "$setOnInsert": {"created": now},
+            },
+            upsert=True,
+        )
+
+    def enqueue_uploads(self, uploads, user):
+        """
+        Queue a batch of uploads, each a dict with the ``file``, the Drive
+        ``gdriveFolderId`` and the ``path`` below it, delayed by the debounce
+        setting.
+        """
+        delay = Setting().get(PluginSettings.GDRIVE_SYNC_DEBOUNCE)
+        for upload in uploads:
+            self.enqueue(
+                upload["file"], upload["gdriveFolderId"], upload["path"], user, delay
+            )
+
+    def claim(self, limit):
+        """Lease up to ``limit`` due uploads, the longest due first."""
+        now = datetime.datetime.utcnow()
+        claimed = []
+        while len(claimed) < limit:
+            doc = self.collection.find_one_and_update(
+                {
+                    "status": SYNC_PENDING,
+                    "dueAt": {"$lte": now},
+                    "$or": [{"leaseUntil": None}, {"leaseUntil": {"$lt": now}}],
+                },
+                {"$set": {"leaseUntil": now + LEASE}},
+                sort=[("dueAt", ASCENDING)],
+                return_document=ReturnDocument.AFTER,
+            )
+            if doc is None:
+                break
+            claimed.append(doc)
+        return claimed
+
+    def complete(self, sync):
+        """
+        Remove a claimed upload, unless its file was written again meanwhile, in
+        which case the newer version stays queued.
+        """
+        result = self.collection.delete_one(
+            {"_id": sync["_id"], "version": sync["version"]}
+        )
+        if not result.deleted_count:
+            self._release(sync)
+
+    def fail(self, sync, error):
+        """Retry a claimed upload later, or mark it as failed after a few attempts."""
+        attempts = sync.get("attempts", 0) + 1
+        delay = datetime.timedelta(seconds=min(30 * 2**attempts, 3600))
+        result = self.collection.update_one(
+            {"_id": sync["_id"], "version": sync["version"]},
+            {
+                "$set": {
+                    "status": SYNC_PENDING if attempts < MAX_ATTEMPTS else SYNC_FAILED,
+                    "attempts": attempts,
+                    "error": str(error),
+                    "dueAt": datetime.datetime.utcnow() + delay,
+                    "leaseUntil": None,
+                }
+            },
+        )
+        if not result.matched_count:
+            self._release(sync)
+
+    def _release(self, sync):
+        self.collection.update_one({"_id": sync["_id"]}, {"$set": {"leaseUntil": None}})
+
+    def status_counts(self):
+        now = datetime.datetime.utcnow()
+        return {
+            "pending": self.collection.count_documents({"status": SYNC_PENDING}),
+            "active": self.collection.count_documents(
+                {"status": SYNC_PENDING, "leaseUntil": {"$gte": now}}
+            ),
+            "failed": self.collection.count_documents({"status": SYNC_FAILED}),
+        }
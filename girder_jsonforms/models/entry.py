@@ -1,23 +1,96 @@
+import collections
+import copy
 import datetime
+import hashlib
 import io
 import json
+import logging
 import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from bson import ObjectId
 from girder import events
 from girder.constants import AccessType
+from girder.models.file import File
 from girder.models.folder import Folder
 from girder.models.item import Item
 from girder.models.model_base import Model
+from girder.models.setting import Setting
 from girder.models.upload import Upload
+from girder.models.user import User
+from girder.notification import Notification
 from girder.utility import acl_mixin, JsonEncoder, RequestBodyStream
+from girder.utility.model_importer import ModelImporter
+from pymongo import ReturnDocument, UpdateOne
+
+from ..lib.cache import LRUCache
+from ..lib.metrics import metrics
+from ..lib.path_template import render_path_template
+from ..settings import PluginSettings
+from .drive_sync import DriveSync
+
+logger = logging.getLogger(__name__)
+
+ENTRY_PENDING = "pending"
+ENTRY_COMPLETE = "complete"
+ENTRY_FAILED = "failed"
+
+ENTRY_INDICES = (
+    ([("formId", 1), ("created", 1), ("_id", 1)], {}),
+    ([("formId", 1), ("updated", 1), ("_id", 1)], {}),
+    ([("formId", 1), ("lowerUniqueValue", 1)], {}),
+    # Only the few entries still being finalized are looked up by status.
+    ([("status", 1)], {"partialFilterExpression": {"status": ENTRY_PENDING}}),
+)
+BATCH_SIZE = 1000
+UNIQUE_INDEX_PREFIX = "jsonforms_unique_"
+_unique_field_indices = set()
+MOVED_ITEM_FIELDS = (
+    "name",
+    "lowerName",
+    "folderId",
+    "baseParentType",
+    "baseParentId",
+    "updated",
+)
+
+# How long an entry being finalized is reserved for the process finalizing it.
+FINALIZE_LEASE = datetime.timedelta(minutes=15)
+
+_finalize_pool = None
+_finalize_pool_lock = threading.Lock()
+
+# Destination folders keyed by (root id, path segments). Each record holds the
+# ids of the folders along the path, so that moving or removing any of them
+# drops the paths running through it.
+_destination_folders = LRUCache(maxsize=1024)
+
+
+def _finalize_executor():
+    """
+    Return the thread pool finalizing entries of asynchronous forms, sized by
+    the finalize workers setting.
+    """
+    global _finalize_pool
+    workers = Setting().get(PluginSettings.FINALIZE_WORKERS)
+    with _finalize_pool_lock:
+        if _finalize_pool is None or _finalize_pool._max_workers != workers:
+            if _finalize_pool is not None:
+                # Queued entries still finalize on the previous pool.
+                _finalize_pool.shutdown(wait=False)
+            _finalize_pool = ThreadPoolExecutor(
+                max_workers=workers, thread_name_prefix="jsonforms-finalize"
+            )
+        return _finalize_pool
 
 
 class FormEntry(acl_mixin.AccessControlMixin, Model):
     def initialize(self):
         global GDRIVE_SERVICE
         self.name = "entry"
-        # TODO: create indices for all pairs?
-        # self.ensureIndices(["formId", "data.sampleId"])
+        self.ensureIndices(ENTRY_INDICES)
         self.resourceColl = ("form", "jsonforms")
         self.resourceParent = "formId"
 
@@ -32,25 +105,196 @@ class FormEntry(acl_mixin.AccessControlMixin, Model):
                 "updated",
                 "files",
                 "folders",
+                "status",
+                "error",
             ),
         )
 
     def validate(self, doc):
         return doc
 
-    def _getExtraPath(self, template, data):
-        # Define a safe set of built-in functions and variables
-        safe_globals = {"__builtins__": None}
-        safe_locals = {"data": data, "ord": ord}
+    @staticmethod
+    def unique_field_index(unique_field):
+        """
+        Return the (keys, options) of the index backing lookups by a unique field.
 
-        # Evaluate the template
-        try:
-            result = eval(f'f"{template}"', safe_globals, safe_locals)
-            return result
-        except Exception as e:
-            print("Error:", e)
+        Forms sharing a unique field share the index. It is partial, so that it
+        only holds entries that actually have the field.
+        """
+        key = f"data.{unique_field}"
+        return [("formId", 1), (key, 1)], {
+            "name": UNIQUE_INDEX_PREFIX + unique_field,
+            "partialFilterExpression": {key: {"$exists": True}},
+        }
+
+    def ensure_unique_field_index(self, form):
+        """Create the index for the form's unique field once per process."""
+        unique_field = form["uniqueField"]
+        if unique_field not in _unique_field_indices:
+            keys, options = self.unique_field_index(unique_field)
+            self.collection.create_index(keys, background=True, **options)
+            _unique_field_indices.add(unique_field)
+
+    def sync_unique_field_indexes(self, exclude=None):
+        """
+        Create indexes for the unique fields of all forms and drop those that are
+        no longer used by any form.
+
+        Args:
+            exclude: The ID of a form to disregard, e.g. one being removed.
+        """
+        from .form import Form
+
+        query = {"_id": {"$ne": exclude}} if exclude is not None else {}
+        required = set(Form().collection.distinct("uniqueField", query)) - {None}
+        for unique_field in required:
+            self.ensure_unique_field_index({"uniqueField": unique_field})
+        for index in list(self.collection.list_indexes()):
+            name = index["name"]
+            if not name.startswith(UNIQUE_INDEX_PREFIX):
+                continue
+            unique_field = name[len(UNIQUE_INDEX_PREFIX) :]
+            if unique_field not in required:
+                self.collection.drop_index(name)
+                _unique_field_indices.discard(unique_field)
+
+    @staticmethod
+    def lower_unique_value(form, data):
+        """
+        Case-folded value of the form's unique field, used for prefix search.
+        """
+        value = data.get(form["uniqueField"])
+        return str(value).casefold() if value is not None else None
+
+    def update_lower_unique_values(self, form):
+        """
+        Recompute ``lowerUniqueValue`` of all entries of the form, and record on
+        the form which unique field the values were computed from.
+        """
+        from .form import Form
+
+        unique_field = form["uniqueField"]
+        requests = []
+        for entry in self.find(
+            {"formId": form["_id"]}, fields={f"data.{unique_field}": 1}
+        ).batch_size(BATCH_SIZE):
+            value = self.lower_unique_value(form, entry.get("data", {}))
+            requests.append(
+                UpdateOne({"_id": entry["_id"]}, {"$set": {"lowerUniqueValue": value}})
+            )
+            if len(requests) >= BATCH_SIZE:
+                self.collection.bulk_write(requests, ordered=False)
+                requests = []
+        if requests:
+            self.collection.bulk_write(requests, ordered=False)
+        Form().update(
+            {"_id": form["_id"]}, {"$set": {"indexedUniqueField": unique_field}}
+        )
+
+    def search(self, form, query, regex=False, user=None, limit=0, offset=0, sort=None):
+        """
+        Search entries by their unique field.
+
+        By default ``query`` is a case-insensitive prefix, matched against the
+        indexed ``lowerUniqueValue``. With ``regex`` set it is an unanchored regular
+        expression matched against the raw unique field, which cannot use an
+        index. Without a form, all forms readable by the user are searched, and
+        the regular expression is matched against ``data.sampleId``.
+        """
+        if regex:
+            field = f"data.{form['uniqueField']}" if form else "data.sampleId"
+            q = {field: {"$regex": query}}
+        else:
+            q = {"lowerUniqueValue": {"$regex": "^" + re.escape(query.casefold())}}
+
+        if form is None:
+            return self.findWithPermissions(
+                q,
+                user=user,
+                level=AccessType.READ,
+                limit=limit,
+                offset=offset,
+                sort=sort,
+            )
+        # Read access to the form grants read access to all of its entries.
+        q["formId"] = form["_id"]
+        return self.find(q, limit=limit, offset=offset, sort=sort)
+
+    @staticmethod
+    def list_projection(form=None, fields=None, summary=False, sort=None):
+        """
+        Build the projection of a lightweight entry listing.
+
+        ``fields`` are dotted paths into the entry data. In ``summary`` mode only
+        the unique field of ``form`` is kept, or ``data.sampleId`` without a form.
+        The ID, form and timestamps are always returned, as well as the sort
+        fields, which paging tokens are built from.
+
+        Returns:
+            dict: A Mongo projection, or None if all fields should be returned.
+        """
+        if summary:
+            fields = [form["uniqueField"] if form else "sampleId"]
+        elif not fields:
             return None
 
+        paths = set()
+        for field in fields:
+            if not field or field.startswith("$") or "" in field.split("."):
+                raise ValueError(f"Invalid field path: {field!r}")
+            paths.add(f"data.{field}")
+        paths.update(key for key, _ in sort or ())
+        paths.update(("_id", "formId", "created", "updated"))
+        # Projecting both a path and one of its parents is a path collision.
+        return {
+            path: 1
+            for path in paths
+            if not any(path.startswith(f"{other}.") for other in paths)
+        }
+
+    def index_status(self):
+        """
+        Report which of the indexes the plugin relies on exist, and which managed
+        indexes are no longer needed.
+        """
+        from .form import Form
+
+        existing = {index["name"]: index for index in self.collection.list_indexes()}
+        expected = {}
+        for keys, options in ENTRY_INDICES:
+            expected["_".join(f"{key}_{order}" for key, order in keys)] = keys, options
+        for unique_field in Form().collection.distinct("uniqueField"):
+            if unique_field is not None:
+                keys, options = self.unique_field_index(unique_field)
+                expected[options["name"]] = keys, options
+
+        status = []
+        for name, (keys, options) in expected.items():
+            status.append(
+                {
+                    "name": name,
+                    "key": dict(keys),
+                    "partialFilterExpression": options.get("partialFilterExpression"),
+                    "present": name in existing,
+                    "required": True,
+                }
+            )
+        for name, index in existing.items():
+            if name.startswith(UNIQUE_INDEX_PREFIX) and name not in expected:
+                status.append(
+                    {
+                        "name": name,
+                        "key": dict(index["key"]),
+                        "partialFilterExpression": index.get("partialFilterExpression"),
+                        "present": True,
+                        "required": False,
+                    }
+                )
+        return status
+
+    def _getExtraPath(self, template, data):
+        return render_path_template(template, data)
+
     def create_entry(self, form, data, source, destination, creator):
         now = datetime.datetime.utcnow()
         unique_field = form.get("uniqueField")
@@ -62,6 +306,7 @@ class FormEntry(acl_mixin.AccessControlMixin, Model):
             "folderId": destination["_id"],
             "files": [],
             "folders": [],
+            "lowerUniqueValue": self.lower_unique_value(form, data),
         }
 
         if existing := self.findOne(
@@ -80,6 +325,99 @@ class FormEntry(acl_mixin.AccessControlMixin, Model):
                 }
             )
 
+        if form.get("asyncFinalize"):
+            entry["status"] = ENTRY_PENDING
+            # Kept until the entry is finalized, so that it can be resumed after
+            # a restart. The entry is leased to this process until then.
+            entry["finalize"] = {
+                "sourceId": source["_id"] if source is not None else None,
+                "destinationId": destination["_id"],
+                "creatorId": creator["_id"],
+                "lease": ObjectId(),
+                "leaseUntil": now + FINALIZE_LEASE,
+            }
+            entry = self.save(entry)
+            self._submit_finalize(entry, form, source, destination, creator)
+            return entry
+        return self.finalize_entry(entry, form, source, destination, creator)
+
+    def _submit_finalize(self, entry, form, source, destination, creator):
+        # The worker must not change the document returned to the caller.
+        _finalize_executor().submit(
+            self._finalize_in_background,
+            copy.deepcopy(entry),
+            form,
+            source,
+            destination,
+            creator,
+        )
+
+    def claim_pending(self):
+        """
+        Lease the next pending entry whose lease has expired, as it does when the
+        process finalizing it stops.
+
+        Returns:
+            dict: The claimed entry, or None.
+        """
+        now = datetime.datetime.utcnow()
+        return self.collection.find_one_and_update(
+            {
+                "status": ENTRY_PENDING,
+                "$or": [
+                    {"finalize.leaseUntil": None},
+                    {"finalize.leaseUntil": {"$lt": now}},
+                ],
+            },
+            {
+                "$set": {
+                    "finalize.lease": ObjectId(),
+                    "finalize.leaseUntil": now + FINALIZE_LEASE,
+                }
+            },
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def resume_pending(self):
+        """
+        Finalize again the entries of asynchronous forms that were left pending
+        by a process that stopped. Entries whose form, destination folder or
+        creator is gone are marked as failed.
+        """
+        while (entry := self.claim_pending()) is not None:
+            pending = entry["finalize"]
+            form = ModelImporter.model("form", "jsonforms").load(
+                entry["formId"], force=True
+            )
+            # The source is removed once its children are moved, so a missing
+            # one has nothing left to move.
+            source, destination, creator = (
+                model.load(pending[key], force=True) if pending.get(key) else None
+                for model, key in (
+                    (Folder(), "sourceId"),
+                    (Folder(), "destinationId"),
+                    (User(), "creatorId"),
+                )
+            )
+            if form is None or destination is None or creator is None:
+                self.update_status(entry, ENTRY_FAILED, "Entry could not be resumed")
+                continue
+            self._submit_finalize(entry, form, source, destination, creator)
+
+    def finalize_entry(self, entry, form, source, destination, creator):
+        """
+        Move the uploaded children of ``source`` into their destination folders,
+        remove ``source``, write the serialized snapshots and save the entry.
+        """
+        self._finalize(entry, form, source, destination, creator)
+        return self.save(entry)
+
+    def _finalize(self, entry, form, source, destination, creator):
+        """Do the work of :meth:`finalize_entry` without saving the entry."""
+        unique_field = form.get("uniqueField")
+        entry["status"] = ENTRY_COMPLETE
+        entry.pop("finalize", None)
+        gdrive_uploads = []
         # Move from temp to destination
         path = entry["data"].get("targetPath")
         known_targets = {
@@ -89,91 +427,241 @@ class FormEntry(acl_mixin.AccessControlMixin, Model):
             )
         }
         if source is not None:
-            for child in Folder().childFolders(source, "folder", user=creator):
+
+            def resolve_target(child):
                 path = child.get("meta", {}).get("targetPath")
                 try:
                     target, _ = known_targets[path]
                 except KeyError:
                     target = self.get_destination_folder(path, destination, creator)
-                    known_targets[path] = target, child.get("meta", {}).get(unique_field)
-                child = self.unique(child, target)
+                    known_targets[path] = (
+                        target,
+                        child.get("meta", {}).get(unique_field),
+                    )
+                return target
+
+            folders = [
+                (child, resolve_target(child))
+                for child in Folder().childFolders(source, "folder", user=creator)
+            ]
+            items = [
+                (child, resolve_target(child)) for child in Folder().childItems(source)
+            ]
+            batches = {}
+            for child, target in folders + items:
+                batches.setdefault(target["_id"], (target, []))[1].append(child)
+            for target, children in batches.values():
+                self.unique_names(children, target)
+
+            for child, target in folders:
                 Folder().move(child, target, "folder")
                 # TODO upload to GDrive
                 entry["folders"].append(child["_id"])
 
-            for child in Folder().childItems(source):
+            moved = self.move_items(items)
+            files = {}
+            if any(child.get("meta", {}).get("gdriveFolderId") for child in moved):
+                for file in File().find({"itemId": {"$in": [c["_id"] for c in moved]}}):
+                    files.setdefault(file["itemId"], []).append(file)
+            for child in moved:
                 path = child.get("meta", {}).get("targetPath")
-                try:
-                    target, _ = known_targets[path]
-                except KeyError:
-                    target = self.get_destination_folder(path, destination, creator)
-                    known_targets[path] = target, child.get("meta", {}).get(unique_field)
-                child = self.unique(child, target)
-                child = Item().move(child, target)
-                for file in Item().childFiles(child):
+                for file in files.get(child["_id"], []):
                     # Upload to GDrive
                     gdrive_folder_id = child.get("meta", {}).get("gdriveFolderId")
                     if gdrive_folder_id:
-                        events.daemon.trigger(
-                            "gdrive.upload",
+                        gdrive_uploads.append(
                             {
                                 "file": file,
                                 "gdriveFolderId": gdrive_folder_id,
                                 "path": os.path.join(path, file["name"]),
-                                "currentUser": creator,
-                            },
+                            }
                         )
                 entry["files"].append(child["_id"])
             Folder().remove(source)
 
-        if not form.get("serialize", False):
-            return self.save(entry)
+        if form.get("serialize", False):
+            gdrive_uploads += self._write_snapshots(entry, form, known_targets, creator)
+        if gdrive_uploads and Setting().get(PluginSettings.GOOGLE_DRIVE_ENABLED):
+            # Queued before the entry is recorded as complete, so that the
+            # uploads are not lost if the server stops.
+            DriveSync().enqueue_uploads(gdrive_uploads, creator)
+
+    def _write_snapshots(self, entry, form, known_targets, creator):
+        """
+        Write the serialized entry to each of its target folders.
 
+        Returns:
+            list: The Drive uploads of the written snapshots.
+        """
+        unique_field = form.get("uniqueField")
+        gdrive_uploads = []
         # Dump the entry into json file, by creating bytes buffer from json dump and
         # Upload().uploadFromFile will create a file in each destination folder
         if len(known_targets) > 1:
             known_targets.pop(None)
 
+        snapshot = json.dumps(
+            entry, sort_keys=True, allow_nan=False, cls=JsonEncoder
+        ).encode("utf-8")
+        snapshot_hash = self.snapshot_hash(entry)
         processed = set()
         for path, (target, uniqueId) in known_targets.items():
             if target["_id"] in processed:
                 continue
+            processed.add(target["_id"])
             path = path or entry["data"].get("targetPath")
-            with io.BytesIO(
-                json.dumps(
-                    entry, sort_keys=True, allow_nan=False, cls=JsonEncoder
-                ).encode("utf-8")
-            ) as f:
+            existing = self._find_entry_file(form["entryFileName"], target)
+            if existing and self.stored_snapshot_hash(existing[1]) == snapshot_hash:
+                metrics.incr("snapshots.skipped")
+                continue
+
+            with io.BytesIO(snapshot) as f:
                 reference = {
                     f"{unique_field}": uniqueId,
                     "targetPath": path,
                     "gdriveFolderId": form.get("gdriveFolderId"),
                 }
-                size = f.getbuffer().nbytes
+                size = len(snapshot)
                 upload = self._get_upload_for_entry(
-                    form["entryFileName"], target, creator, size, reference
+                    form["entryFileName"], target, creator, size, reference, existing
                 )
                 # not really chunking here as JSON is small
                 upload = Upload().handleChunk(upload, RequestBodyStream(f, size))
+                File().update(
+                    {"_id": upload["_id"]},
+                    {
+                        "$set": {
+                            "snapshotHash": {
+                                "hash": snapshot_hash,
+                                "size": upload["size"],
+                                "created": upload.get("created"),
+                            }
+                        }
+                    },
+                )
+                metrics.incr("snapshots.written")
                 if form.get("gdriveFolderId"):
-                    events.daemon.trigger(
-                        "gdrive.upload",
+                    gdrive_uploads.append(
                         {
                             "file": upload,
                             "gdriveFolderId": form["gdriveFolderId"],
                             "gdriveFileId": reference.get("gdriveFileId"),
                             "path": os.path.join(path, upload["name"]),
-                            "currentUser": creator,
-                        },
+                        }
                     )
-            processed.add(target["_id"])
 
-        return self.save(entry)
+        return gdrive_uploads
+
+    def _renew_lease(self, entry):
+        """
+        Extend the lease of ``entry``, unless another process has claimed it
+        since it was queued.
+        """
+        result = self.collection.update_one(
+            {
+                "_id": entry["_id"],
+                "status": ENTRY_PENDING,
+                "finalize.lease": entry["finalize"]["lease"],
+            },
+            {
+                "$set": {
+                    "finalize.leaseUntil": datetime.datetime.utcnow() + FINALIZE_LEASE
+                }
+            },
+        )
+        return bool(result.matched_count)
+
+    def _finalize_in_background(self, entry, form, source, destination, creator):
+        if not self._renew_lease(entry):
+            logger.info("Entry %s is finalized by another process", entry["_id"])
+            return
+        try:
+            self._finalize(entry, form, source, destination, creator)
+        except Exception as exc:
+            logger.exception("Failed to finalize entry %s", entry["_id"])
+            entry = self.update_status(entry, ENTRY_FAILED, str(exc))
+        else:
+            entry = self.update_status(entry, ENTRY_COMPLETE)
+        Notification(
+            "jsonforms.entry.status",
+            {
+                "_id": entry["_id"],
+                "formId": entry["formId"],
+                "status": entry["status"],
+                "error": entry.get("error"),
+            },
+            creator,
+        ).flush()
+        metrics.incr(f"entries.{entry['status']}")
+
+    def update_status(self, entry, status, error=None):
+        """
+        Record the outcome of finalizing ``entry``, along with the files and
+        folders it has moved so far.
+
+        Only these fields are updated, so that changes saved to the entry while
+        it was being finalized are kept.
+        """
+        entry["status"] = status
+        entry["error"] = error
+        entry["updated"] = datetime.datetime.utcnow()
+        entry.pop("finalize", None)
+        self.update(
+            {"_id": entry["_id"]},
+            {
+                "$set": {key: entry[key] for key in ("status", "error", "updated")},
+                "$addToSet": {
+                    "files": {"$each": entry["files"]},
+                    "folders": {"$each": entry["folders"]},
+                },
+                "$unset": {"finalize": ""},
+            },
+            multi=False,
+        )
+        return entry
+
+    @staticmethod
+    def snapshot_hash(entry):
+        """
+        Hash the serialized snapshot of ``entry``, leaving out its ``updated``
+        timestamp, which changes on every save.
+        """
+        content = {key: value for key, value in entry.items() if key != "updated"}
+        return hashlib.sha256(
+            json.dumps(
+                content, sort_keys=True, allow_nan=False, cls=JsonEncoder
+            ).encode("utf-8")
+        ).hexdigest()
+
+    @staticmethod
+    def stored_snapshot_hash(file):
+        """
+        Return the snapshot hash recorded on the file of a written snapshot.
+
+        As with the checksums cached by ``file_md5``, the hash is only used while
+        the size and creation time of the file still match, since replacing the
+        content of the file keeps its document but resets both.
+        """
+        stored = file.get("snapshotHash")
+        if (
+            isinstance(stored, dict)
+            and stored.get("size") == file["size"]
+            and stored.get("created") == file.get("created")
+        ):
+            return stored["hash"]
+        return None
+
+    @staticmethod
+    def _find_entry_file(fname, target):
+        existing_item = Item().findOne({"name": fname, "folderId": target["_id"]})
+        if existing_item and (files := list(Item().childFiles(existing_item, limit=1))):
+            return existing_item, files[0]
+        return None
 
     @staticmethod
-    def _get_upload_for_entry(fname, target, creator, size, reference):
-        if existing_item := Item().findOne({"name": fname, "folderId": target["_id"]}):
-            file = Item().childFiles(existing_item)[0]
+    def _get_upload_for_entry(fname, target, creator, size, reference, existing=None):
+        if existing:
+            existing_item, file = existing
             if "gdriveFileId" in existing_item.get("meta", {}):
                 reference["gdriveFileId"] = existing_item["meta"]["gdriveFileId"]
             reference["itemId"] = existing_item["_id"]
@@ -200,46 +688,159 @@ class FormEntry(acl_mixin.AccessControlMixin, Model):
 
     @staticmethod
     def get_destination_folder(path, root, user):
+        """
+        Find or create the folder at ``path`` below ``root``.
+
+        Resolved paths are cached, so that only the folder at the longest cached
+        prefix is loaded, and only the missing tail of the path is created.
+        """
         if path is None:
             return root
 
-        destination = root
-        for subfolder in path.split(os.path.sep):
+        segments = tuple(path.split(os.path.sep))
+        destination, ids = root, ()
+        for depth in range(len(segments), 0, -1):
+            cached = _destination_folders.get((root["_id"], segments[:depth]))
+            if cached is None:
+                continue
+            folder = Folder().load(cached[-1], force=True)
+            parent_id = cached[-2] if depth > 1 else root["_id"]
+            if (
+                folder is not None
+                and folder["parentId"] == parent_id
+                and folder["name"] == segments[depth - 1]
+            ):
+                destination, ids = folder, cached
+                break
+            # Changed outside of this process.
+            FormEntry.invalidate_destination_folder({"_id": cached[-1]})
+
+        for depth in range(len(ids), len(segments)):
             destination = Folder().createFolder(
                 destination,
-                subfolder,
+                segments[depth],
                 parentType="folder",
                 creator=user,
                 reuseExisting=True,
             )
+            ids += (destination["_id"],)
+            _destination_folders.set((root["_id"], segments[: depth + 1]), ids)
 
         return destination
 
+    @staticmethod
+    def invalidate_destination_folder(folder):
+        """Forget cached destination paths that run through ``folder``."""
+        _destination_folders.discard(
+            lambda key, ids: key[0] == folder["_id"] or folder["_id"] in ids
+        )
+
+    @staticmethod
+    def move_items(children):
+        """
+        Move items into their target folders in bulk.
+
+        ``children`` is a list of ``(item, target)`` pairs, with the items already
+        renamed by :meth:`unique_names`. As ``Item().move`` would,
+        ``model.item.validate`` and ``model.item.save`` are triggered for every
+        item, the latter may prevent its move, and ``model.item.save.after`` is
+        triggered for every moved item. ``Item().validate`` itself is not called,
+        as :meth:`unique_names` has already made the names unique. The items are
+        updated with one bulk write, and each folder and base parent size is
+        adjusted once.
+
+        Returns:
+            list: The moved items.
+        """
+        now = datetime.datetime.utcnow()
+        sizes = collections.Counter()
+        requests = []
+        moved = []
+        for item, target in children:
+            size = item.get("size", 0)
+            parents = (
+                ("folder", item["folderId"]),
+                (item["baseParentType"], item["baseParentId"]),
+            )
+            item["folderId"] = target["_id"]
+            item["baseParentType"] = target["baseParentType"]
+            item["baseParentId"] = target["baseParentId"]
+            item["updated"] = now
+            events.trigger("model.item.validate", item)
+            if events.trigger("model.item.save", item).defaultPrevented:
+                continue
+            for parent in parents:
+                sizes[parent] -= size
+            sizes["folder", item["folderId"]] += size
+            sizes[item["baseParentType"], item["baseParentId"]] += size
+            requests.append(
+                UpdateOne(
+                    {"_id": item["_id"]},
+                    {"$set": {key: item[key] for key in MOVED_ITEM_FIELDS}},
+                )
+            )
+            moved.append(item)
+        if not requests:
+            return []
+        Item().collection.bulk_write(requests, ordered=False)
+        for (model, doc_id), amount in sizes.items():
+            if amount:
+                ModelImporter.model(model).increment(
+                    query={"_id": doc_id}, field="size", amount=amount, multi=False
+                )
+        for item in moved:
+            events.trigger("model.item.save.after", item)
+        return moved
+
     @staticmethod
     def unique(child, destination):
-        name = child["name"]
-        n = 0
-        checkName = True
-        while checkName:
-            q = {
-                "name": name,
-                "folderId": destination["_id"],
-                "_id": {"$ne": child["_id"]},
-            }
-            dupItem = Item().findOne(q, fields=["_id"])
-            q = {
-                "name": name,
-                "parentId": destination["_id"],
-                "parentCollection": "folder",
-            }
-            dupFolder = Folder().findOne(q, fields=["_id"])
+        return FormEntry.unique_names([child], destination)[0]
+
+    @staticmethod
+    def unique_names(children, destination):
+        """
+        Rename items and folders about to be moved into ``destination`` so that
+        their names collide neither with its contents nor with each other.
 
-            if dupItem is None and dupFolder is None:
-                child["name"] = name
-                checkName = False
-            else:
+        A colliding ``name`` becomes ``name (n)``, with the lowest free ``n``.
+        Existing names are fetched with one query on items and one on folders.
+        """
+        if not children:
+            return children
+        bases = sorted({child["name"] for child in children})
+        names = "|".join(map(re.escape, bases))
+        pattern = rf"^(?:{names})(?: \(\d+\))?$"
+        ids = [child["_id"] for child in children]
+        taken = {
+            doc["name"]
+            for doc in Item().find(
+                {
+                    "folderId": destination["_id"],
+                    "name": {"$regex": pattern},
+                    "_id": {"$nin": ids},
+                },
+                fields=["name"],
+            )
+        }
+        taken.update(
+            doc["name"]
+            for doc in Folder().find(
+                {
+                    "parentId": destination["_id"],
+                    "parentCollection": "folder",
+                    "name": {"$regex": pattern},
+                    "_id": {"$nin": ids},
+                },
+                fields=["name"],
+            )
+        )
+
+        for child in children:
+            name, n = child["name"], 0
+            while name in taken:
                 n += 1
                 name = f"{child['name']} ({n})"
-
-        child["lowerName"] = child["name"].lower()
-        return child
+            taken.add(name)
+            child["name"] = name
+            child["lowerName"] = name.lower()
+        return children
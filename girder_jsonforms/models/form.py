@@ -1,21 +1,40 @@
 import datetime
 import io
 import json
+import re
+import tempfile
 
-import jsonschema
 import numpy as np
 import pandas as pd
-import requests
 from girder.constants import AccessType
+from girder.exceptions import ValidationException
 from girder.models.model_base import AccessControlledModel
+from girder.models.setting import Setting
+from pymongo import UpdateOne
 
+from ..lib.cache import LRUCache
+from ..lib.export import iter_csv, measure_arrays, table_columns, write_xlsx
+from ..lib.importer import RowValidator, buffered
 from ..lib.jq import (
     convert_to_jq_notation,
     find_key_paths,
     get_value,
+    iter_jq_keys,
     parse_jq_notation,
     set_value,
 )
+from ..lib.path_template import PathTemplateError, compile_path_template
+from ..lib.remote_schema import remote_schemas
+from ..settings import PluginSettings
+
+ENUM_SOURCE_PREFIX = "girder.formId:"
+ENUM_MODES = ("inline", "remote")
+EXPORT_BATCH_SIZE = 1000
+IMPORT_BATCH_SIZE = 1000
+
+# Materialized schemas keyed by form id. Each record remembers the form revision
+# and the state of the referenced source forms it was built from.
+_materialized = LRUCache(maxsize=256)
 
 
 class Form(AccessControlledModel):
@@ -38,12 +57,28 @@ class Form(AccessControlledModel):
                 "serialize",
                 "pathTemplate",
                 "uniqueField",
+                "asyncFinalize",
             ),
         )
 
     def validate(self, doc):
         return doc
 
+    @staticmethod
+    def validate_path_template(form, template):
+        """
+        Check a ``pathTemplate`` about to be set on ``form``.
+
+        Only new templates are checked, so that forms saved with a template that
+        predates the restricted syntax can still be saved for unrelated changes.
+        """
+        if not template or template == form.get("pathTemplate"):
+            return
+        try:
+            compile_path_template(template)
+        except PathTemplateError as exc:
+            raise ValidationException(str(exc), "pathTemplate") from exc
+
     def create_form(
         self,
         name,
@@ -56,7 +91,9 @@ class Form(AccessControlledModel):
         gdriveFolderId=None,
         serialize=False,
         uniqueField=None,
+        asyncFinalize=False,
     ):
+        self.validate_path_template({}, pathTemplate)
         now = datetime.datetime.utcnow()
 
         form = {
@@ -68,9 +105,12 @@ class Form(AccessControlledModel):
             "pathTemplate": pathTemplate,
             "entryFileName": entryFileName or "entry.json",
             "serialize": serialize,
+            "asyncFinalize": asyncFinalize,
             "created": now,
             "updated": now,
             "uniqueField": uniqueField or "sampleId",
+            # A new form has no entries whose search keys would need an update.
+            "indexedUniqueField": uniqueField or "sampleId",
         }
         if folder:
             form["folderId"] = folder["_id"]
@@ -89,7 +129,9 @@ class Form(AccessControlledModel):
         gdriveFolderId=None,
         serialize=None,
         uniqueField=None,
+        asyncFinalize=None,
     ):
+        self.validate_path_template(form, pathTemplate)
         now = datetime.datetime.utcnow()
 
         form["name"] = name
@@ -115,64 +157,253 @@ class Form(AccessControlledModel):
         if uniqueField:
             form["uniqueField"] = uniqueField
 
+        if asyncFinalize is not None:
+            form["asyncFinalize"] = asyncFinalize
+
         return self.save(form)
 
-    def materialize(self, form, user):
-        from .entry import FormEntry
+    def materialize(self, form, user, enum_mode="inline"):
+        """
+        Load the form schema and resolve its ``girder.formId:`` enum sources.
 
+        With ``enum_mode="inline"`` every entry of a source form is embedded in the
+        schema. With ``enum_mode="remote"`` a reference to ``GET /form/:id/enum``
+        is emitted instead, so that the client can look values up on demand.
+        """
+        remote = None
         if form["schema"].startswith("http"):
-            form["schema"] = self._loadRemoteSchema(form["schema"])
-        else:
-            form["schema"] = json.loads(form["schema"])
-
-        for keyPath in find_key_paths(form["schema"], "enumSource"):
-            value = get_value(form["schema"], keyPath)
-            if isinstance(value, str) and value.startswith("girder.formId:"):
-                formId = value.split(":")[1]
-                source_form = self.load(
-                    formId, level=AccessType.READ, user=user, exc=True
-                )
-                enum_source = {
-                    "source": [],
-                    "title": "{{item.title}}",
-                    "value": "{{item.value}}",
-                }
-                for entry in (
-                    FormEntry()
-                    .find(
-                        {"formId": source_form["_id"]},
-                        fields={"_id": 1, source_form["uniqueField"]: 1, "data": 1},
-                    )
-                    .sort([(source_form["uniqueField"], 1)])
-                ):
-                    enum_source["source"].append(
-                        {
-                            "value": str(entry["_id"]),
-                            "title": entry["data"][source_form["uniqueField"]],
-                        }
-                    )
-                    set_value(form["schema"], keyPath, [enum_source])
-
+            remote = self._loadRemoteSchema(form["schema"])
+
+        def is_current(record):
+            if record["updated"] != form.get("updated"):
+                return False
+            if record["remoteVersion"] != (remote.version if remote else None):
+                return False
+            sources = self._load_sources(record["enumSources"], user)
+            return record["version"] == self._sources_version(sources)
+
+        record = _materialized.get((form["_id"], enum_mode), validate=is_current)
+        if record is None:
+            schema = json.loads(remote.content if remote else form["schema"])
+            enum_sources = self._find_enum_sources(schema)
+            sources = self._load_sources(enum_sources, user)
+            # Take the version before reading entries, so that a concurrent write
+            # results in a stale record rather than a wrong one.
+            version = self._sources_version(sources)
+            if enum_mode == "remote":
+                self._reference_enum_sources(schema, enum_sources, sources)
+            else:
+                self._resolve_enum_sources(schema, enum_sources, sources)
+            record = {
+                "updated": form.get("updated"),
+                "remoteVersion": remote.version if remote else None,
+                "enumSources": enum_sources,
+                "version": version,
+                "schema": schema,
+            }
+            _materialized.set((form["_id"], enum_mode), record)
+
+        # The cached schema is shared between requests and must not be modified.
+        form["schema"] = record["schema"]
         return form
 
-    def export_form(self, form, export_format):
+    @staticmethod
+    def _find_enum_sources(schema):
+        enum_sources = []
+        for keyPath in find_key_paths(schema, "enumSource"):
+            value = get_value(schema, keyPath)
+            if isinstance(value, str) and value.startswith(ENUM_SOURCE_PREFIX):
+                enum_sources.append((keyPath, value.split(":")[1]))
+        return tuple(enum_sources)
+
+    def _load_sources(self, enum_sources, user):
+        return {
+            formId: self.load(formId, level=AccessType.READ, user=user, exc=True)
+            for formId in sorted({formId for _, formId in enum_sources})
+        }
+
+    @staticmethod
+    def _sources_version(sources):
         from .entry import FormEntry
 
-        entries = [
-            convert_to_jq_notation(entry)
-            for entry in FormEntry()
-            .find(
-                {"formId": form["_id"]},
-                fields={"_id": 1, "data": 1},
+        version = []
+        for formId, source_form in sources.items():
+            latest = FormEntry().findOne(
+                {"formId": source_form["_id"]},
+                sort=[("updated", -1)],
+                fields=["updated"],
             )
-            .sort([("created", 1)])
+            version.append(
+                (
+                    formId,
+                    source_form.get("updated"),
+                    source_form["uniqueField"],
+                    latest["updated"] if latest else None,
+                )
+            )
+        return tuple(version)
+
+    @staticmethod
+    def _resolve_enum_sources(schema, enum_sources, sources):
+        from .entry import FormEntry
+
+        for keyPath, formId in enum_sources:
+            source_form = sources[formId]
+            unique_field = f"data.{source_form['uniqueField']}"
+            enum_source = {
+                "source": [],
+                "title": "{{item.title}}",
+                "value": "{{item.value}}",
+            }
+            for entry in (
+                FormEntry()
+                .find(
+                    {"formId": source_form["_id"]},
+                    fields={"_id": 1, unique_field: 1},
+                )
+                .sort([(unique_field, 1)])
+            ):
+                enum_source["source"].append(
+                    {
+                        "value": str(entry["_id"]),
+                        "title": entry["data"][source_form["uniqueField"]],
+                    }
+                )
+            set_value(schema, keyPath, [enum_source])
+
+    @staticmethod
+    def _reference_enum_sources(schema, enum_sources, sources):
+        for keyPath, formId in enum_sources:
+            enum_source = {
+                "source": [],
+                "remote": f"form/{sources[formId]['_id']}/enum",
+                "title": "{{item.title}}",
+                "value": "{{item.value}}",
+            }
+            set_value(schema, keyPath, [enum_source])
+
+    def enum_values(self, form, prefix=None, limit=50, offset=0):
+        """
+        List ``{value, title}`` pairs of the form's entries, ordered by the unique
+        field and optionally filtered by a prefix of it.
+        """
+        from .entry import FormEntry
+
+        unique_field = f"data.{form['uniqueField']}"
+        # The existence clause lets the planner use the partial unique field index,
+        # which is kept in sync with the forms by sync_unique_field_indexes.
+        query = {"formId": form["_id"], unique_field: {"$exists": True}}
+        if prefix:
+            query[unique_field]["$regex"] = "^" + re.escape(prefix)
+        cursor = FormEntry().find(
+            query,
+            fields={"_id": 1, unique_field: 1},
+            sort=[(unique_field, 1)],
+            offset=offset,
+            limit=limit,
+        )
+        return [
+            {
+                "value": str(entry["_id"]),
+                "title": entry["data"][form["uniqueField"]],
+            }
+            for entry in cursor
         ]
-        buffer = io.BytesIO()
-        if export_format == "csv":
-            pd.DataFrame(entries).to_csv(buffer, index=False)
-        elif export_format == "xlsx":
-            pd.DataFrame(entries).to_excel(buffer, index=False)
-        return buffer
+
+    @staticmethod
+    def clear_materialized(formId):
+        """
+        Drop cached materialized schemas of the form and of every form that uses
+        it as an enum source.
+        """
+        formId = str(formId)
+        return _materialized.discard(
+            lambda key, record: str(key[0]) == formId
+            or any(source == formId for _, source in record["enumSources"])
+        )
+
+    @staticmethod
+    def materialized_cache_info():
+        return _materialized.info()
+
+    def export_columns(self, form):
+        """
+        Compute the export header for the form.
+
+        Columns described by the schema come first, in schema order, with arrays
+        expanded to the longest array stored in any entry. Keys of stored data the
+        schema does not describe follow, in the order they are first seen. Both
+        are collected in an extra pass over the entries projected to ``data``.
+
+        The header has to be complete before the first row is written, so an
+        export reads the entries twice and sends nothing until this pass is
+        done. Memory stays flat, as only the columns are kept. Deriving the
+        header from the schema alone would start sooner but drop the data it
+        does not describe.
+        """
+        from .entry import FormEntry
+
+        types = self.get_data_types(form)
+        lengths = {}
+        seen = {}
+        for entry in FormEntry().find(
+            {"formId": form["_id"]}, fields=["data"]
+        ).batch_size(EXPORT_BATCH_SIZE):
+            keys = list(iter_jq_keys(entry))
+            measure_arrays(keys, lengths)
+            seen.update(dict.fromkeys(keys))
+        columns = ["_id"] + table_columns(types, lengths)
+        known = set(columns)
+        return columns + [key for key in seen if key not in known]
+
+    def iter_csv_export(self, form, batch_size=EXPORT_BATCH_SIZE):
+        """
+        Export form entries as CSV chunks, reading entries in batches.
+        """
+        from .entry import FormEntry
+
+        columns = self.export_columns(form)
+        cursor = FormEntry().find(
+            {"formId": form["_id"]},
+            fields={"_id": 1, "data": 1},
+            sort=[("created", 1)],
+        ).batch_size(batch_size)
+        return iter_csv(
+            columns,
+            (convert_to_jq_notation(entry) for entry in cursor),
+            batch_size=batch_size,
+        )
+
+    def xlsx_export(self, form, batch_size=EXPORT_BATCH_SIZE):
+        """
+        Export form entries as an XLSX workbook spooled to a temporary file.
+
+        Returns:
+            file: An open temporary file positioned at the start of the workbook.
+                The caller is responsible for closing it.
+        """
+        from .entry import FormEntry
+
+        columns = self.export_columns(form)
+        types = self.get_data_types(form)
+        cursor = FormEntry().find(
+            {"formId": form["_id"]},
+            fields={"_id": 1, "data": 1},
+            sort=[("created", 1)],
+        ).batch_size(batch_size)
+        fh = tempfile.TemporaryFile()
+        try:
+            write_xlsx(
+                columns,
+                types,
+                (convert_to_jq_notation(entry) for entry in cursor),
+                fh,
+            )
+        except Exception:
+            fh.close()
+            raise
+        fh.seek(0)
+        return fh
 
     @staticmethod
     def resolve_ref(ref, definitions):
@@ -183,7 +414,7 @@ class Form(AccessControlledModel):
         return ref_value
 
     def get_data_types(self, form):
-        schema = json.loads(form["schema"])
+        schema = self._load_schema(form)
         types = self.infer_column_types(
             schema, definitions=schema.get("definitions", {})
         )
@@ -241,47 +472,177 @@ class Form(AccessControlledModel):
 
         return properties
 
-    def import_entries(self, form, file_obj, file_type, dry_run=True):
-        from .entry import FormEntry
+    def import_entries(self, form, file_obj, file_type, dry_run=True, chunked=False):
+        """
+        Import entries from a CSV or XLSX file.
 
-        schema = json.loads(form["schema"])
-        io_buffer = io.BytesIO(file_obj.read())
+        Rows are validated against the form schema and matched to existing
+        entries by the form's unique field. Unless ``dry_run`` is set, new rows are
+        inserted and matching entries have their data replaced.
+
+        CSV files are parsed from ``file_obj`` incrementally, one batch of rows at
+        a time. With ``chunked`` set, only failed rows are reported individually,
+        so that memory stays bounded regardless of the size of the file.
+
+        Returns:
+            dict: Counts of new, updated and failed rows, and a per-row result.
+        """
+        validator = RowValidator(
+            self._load_schema(form), workers=Setting().get(PluginSettings.IMPORT_WORKERS)
+        )
+        summary = {"dryRun": dry_run, "new": 0, "updated": 0, "failed": 0, "rows": []}
+        first_row = 1
+        # Unique ids of new rows in earlier batches of a dry run, which are not
+        # written and thus not found by the classification query.
+        seen = set()
+        with validator:
+            for rows in self._iter_import_batches(form, file_obj, file_type):
+                results = self._import_batch(
+                    form, validator, rows, first_row, dry_run, seen
+                )
+                for result in results:
+                    summary[result["status"]] += 1
+                    if not chunked or result["status"] == "failed":
+                        summary["rows"].append(result)
+                first_row += len(rows)
+        if not dry_run:
+            self.clear_materialized(form["_id"])
+        return summary
+
+    def _iter_import_batches(self, form, file_obj, file_type):
         if file_type == "csv":
-            entries = pd.read_csv(
-                io_buffer, na_values=["None", "nan"], dtype=self.get_data_types(form)
+            frames = pd.read_csv(
+                buffered(file_obj),
+                na_values=["None", "nan"],
+                dtype=self.get_data_types(form),
+                chunksize=IMPORT_BATCH_SIZE,
             )
         elif file_type == "xlsx":
-            entries = pd.read_excel(io_buffer)
-
-        for col in entries.columns:
-            if entries[col].dtype == "object":
-                entries[col] = entries[col].replace(np.nan, "")
+            # XLSX is a zip archive, which cannot be parsed without random access.
+            frames = [pd.read_excel(io.BytesIO(file_obj.read()))]
+
+        for entries in frames:
+            for col in entries.columns:
+                if entries[col].dtype == "object":
+                    entries[col] = entries[col].replace(np.nan, "")
+
+            records = entries.to_dict(orient="records")
+            del entries
+            for start in range(0, len(records), IMPORT_BATCH_SIZE):
+                yield [
+                    parse_jq_notation(record)
+                    for record in records[start : start + IMPORT_BATCH_SIZE]
+                ]
+
+    def _import_batch(self, form, validator, rows, first_row, dry_run, seen):
+        """
+        Validate a batch of parsed rows, classify them with a single query and,
+        unless ``dry_run`` is set, upsert them with a single bulk write. In a dry
+        run, the unique ids of new rows are added to ``seen``.
+        """
+        from .entry import FormEntry
 
-        parsed_entries = [
-            parse_jq_notation(entry) for entry in entries.to_dict(orient="records")
-        ]
-        failed = new = updated = 0
-        for row in parsed_entries:
-            entry = row["data"]
-            try:
-                jsonschema.Draft7Validator(schema).validate(entry)
-            except jsonschema.ValidationError as e:
-                print(str(e))
-                failed += 1
+        unique_field = form["uniqueField"]
+        results = []
+        valid = []
+        data_rows = [row.get("data") for row in rows]
+        errors = iter(
+            validator.validate([data for data in data_rows if isinstance(data, dict)])
+        )
+        for row_number, data in enumerate(data_rows, first_row):
+            if not isinstance(data, dict):
+                results.append(
+                    {"row": row_number, "status": "failed", "error": "No data columns"}
+                )
                 continue
-            try:
-                unique_id = entry[form["uniqueField"]]
-            except KeyError:
-                failed += 1
+            if error := next(errors):
+                results.append({"row": row_number, "status": "failed", "error": error})
                 continue
-            if existing_entry := FormEntry().findOne(
-                {"formId": form["_id"], f"data.{form['uniqueField']}": unique_id}
-            ):
-                updated += 1
-                print("Updating entry", existing_entry["_id"])
+            if unique_field not in data:
+                results.append(
+                    {
+                        "row": row_number,
+                        "status": "failed",
+                        "error": f"Missing unique field {unique_field}",
+                    }
+                )
+                continue
+            result = {"row": row_number, "status": "new"}
+            results.append(result)
+            valid.append((result, data))
+
+        existing = {
+            entry["data"][unique_field]: entry["_id"]
+            for entry in FormEntry().find(
+                {
+                    "formId": form["_id"],
+                    f"data.{unique_field}": {
+                        "$in": [data[unique_field] for _, data in valid]
+                    },
+                },
+                fields={f"data.{unique_field}": 1},
+            )
+        }
+        # Rows repeating a unique id update the entry created by the first one.
+        first = {}
+        duplicates = []
+        for result, data in valid:
+            unique_id = data[unique_field]
+            if unique_id in existing:
+                result["status"] = "updated"
+                result["_id"] = existing[unique_id]
+            elif unique_id in first:
+                result["status"] = "updated"
+                duplicates.append((result, first[unique_id]))
+            elif unique_id in seen:
+                result["status"] = "updated"
             else:
-                new += 1
-        return json.dumps({"new": new, "updated": updated, "failed": failed})
+                first[unique_id] = result
+
+        if dry_run:
+            seen.update(first)
+        if dry_run or not valid:
+            return results
+
+        now = datetime.datetime.utcnow()
+        requests = [
+            UpdateOne(
+                {"formId": form["_id"], f"data.{unique_field}": data[unique_field]},
+                {
+                    "$set": {
+                        "data": data,
+                        "updated": now,
+                        "lowerUniqueValue": FormEntry.lower_unique_value(form, data),
+                    },
+                    "$setOnInsert": {
+                        "formId": form["_id"],
+                        "folderId": form.get("folderId"),
+                        "created": now,
+                        "files": [],
+                        "folders": [],
+                    },
+                },
+                upsert=True,
+            )
+            for _, data in valid
+        ]
+        response = FormEntry().collection.bulk_write(requests, ordered=True)
+        for index, _id in response.upserted_ids.items():
+            valid[index][0]["_id"] = _id
+        for result, original in duplicates:
+            result["_id"] = original["_id"]
+        return results
+
+    def _load_schema(self, form):
+        if form["schema"].startswith("http"):
+            return json.loads(self._loadRemoteSchema(form["schema"]).content)
+        return json.loads(form["schema"])
 
     def _loadRemoteSchema(self, url):
-        return requests.get(url).json()
+        policy = Setting().get(PluginSettings.REMOTE_SCHEMA)
+        return remote_schemas.fetch(
+            url,
+            ttl=policy["ttl"],
+            stale_ttl=policy["staleTtl"],
+            timeout=policy["timeout"],
+        )
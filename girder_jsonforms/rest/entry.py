@@ -1,9 +1,13 @@
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
 from girder.api.rest import Resource, filtermodel
+from girder.exceptions import RestException
 from girder.constants import AccessType, TokenScope
 from girder.models.folder import Folder
 
+from ..lib.metrics import metrics
+from ..lib.pagination import keyset_params, set_next_page_header
+from ..models.drive_sync import DriveSync as DriveSyncModel
 from ..models.form import Form as FormModel
 from ..models.entry import FormEntry as FormEntryModel
 
@@ -14,6 +18,9 @@ class FormEntry(Resource):
         self.resourceName = "entry"
         self.route("GET", (), self.listFormEntry)
         self.route("GET", ("search",), self.searchFormEntry)
+        self.route("GET", ("index",), self.getIndexStatus)
+        self.route("GET", ("metrics",), self.getMetrics)
+        self.route("GET", ("gdrive",), self.getDriveSyncStatus)
         self.route("GET", (":id",), self.getFormEntry)
         self.route("POST", (), self.createFormEntry)
         self.route("DELETE", (":id",), self.deleteFormEntry)
@@ -21,6 +28,10 @@ class FormEntry(Resource):
     @access.public
     @autoDescribeRoute(
         Description("List all entries")
+        .notes(
+            "Pass the value of the Girder-Next-Page response header as 'after' to "
+            "fetch the following page without skipping over the preceding ones."
+        )
         .modelParam(
             "formId",
             "The ID of the form",
@@ -29,42 +40,137 @@ class FormEntry(Resource):
             paramType="query",
             required=False,
         )
+        .param(
+            "after",
+            "Opaque token of the last entry of the previous page",
+            required=False,
+            dataType="string",
+        )
+        .param(
+            "fields",
+            "Comma-separated dotted paths into the entry data to return, e.g. "
+            "'sampleId,meta.date'. Other data fields, files and folders are omitted.",
+            required=False,
+            dataType="string",
+        )
+        .param(
+            "summary",
+            "Only return the ID, unique field and timestamps of entries",
+            required=False,
+            dataType="boolean",
+            default=False,
+        )
         .pagingParams(defaultSort="created")
     )
-    def listFormEntry(self, form, limit, offset, sort):
+    def listFormEntry(self, form, after, fields, summary, limit, offset, sort):
+        page, sort, offset = keyset_params(after, sort, offset)
+        if fields is not None:
+            fields = [field.strip() for field in fields.split(",")]
+        try:
+            projection = FormEntryModel.list_projection(form, fields, summary, sort)
+        except ValueError as exc:
+            raise RestException(str(exc)) from exc
         q = {}
         if form:
             q = {"formId": form["_id"]}
+        if page:
+            q = {"$and": [q, page]}
 
-        cursor = FormEntryModel().findWithPermissions(
-            q,
-            sort=sort,
-            user=self.getCurrentUser(),
-            level=AccessType.READ,
-            limit=limit,
-            offset=offset,
-        )
-        return list(cursor)
+        if form:
+            # Read access to the form grants read access to all of its entries.
+            cursor = FormEntryModel().find(
+                q, sort=sort, limit=limit, offset=offset, fields=projection
+            )
+        else:
+            cursor = FormEntryModel().findWithPermissions(
+                q,
+                fields=projection,
+                sort=sort,
+                user=self.getCurrentUser(),
+                level=AccessType.READ,
+                limit=limit,
+                offset=offset,
+            )
+        entries = list(cursor)
+        set_next_page_header(entries, sort, limit)
+        return entries
 
     @access.public
     @autoDescribeRoute(
-        Description("Search entries")
-        .param("query", "Regex for Sample Id", dataType="string", required=True)
-        .pagingParams(defaultSort="data.sampleId")
+        Description("Search entries by their unique field")
+        .param(
+            "query",
+            "Case-insensitive prefix of the unique field, or a regular expression "
+            "if regex is set",
+            dataType="string",
+            required=True,
+        )
+        .modelParam(
+            "formId",
+            "Only search entries of this form",
+            model=FormModel,
+            level=AccessType.READ,
+            paramType="query",
+            required=False,
+        )
+        .param(
+            "regex",
+            "Whether the query is an unanchored regular expression. Such queries "
+            "cannot use an index.",
+            dataType="boolean",
+            required=False,
+            default=False,
+        )
+        .pagingParams(defaultSort="lowerUniqueValue")
     )
-    def searchFormEntry(self, query, limit, offset, sort):
-        print(query)
-        q = {"data.sampleId": {"$regex": query}}
-        cursor = FormEntryModel().findWithPermissions(
-            q,
+    def searchFormEntry(self, query, form, regex, limit, offset, sort):
+        cursor = FormEntryModel().search(
+            form,
+            query,
+            regex=regex,
             user=self.getCurrentUser(),
-            level=AccessType.READ,
             limit=limit,
             offset=offset,
             sort=sort,
         )
         return list(cursor)
 
+    @access.admin(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description("Report the status of indexes on form entries").errorResponse(
+            "Admin access was denied.", 403
+        )
+    )
+    def getIndexStatus(self):
+        return FormEntryModel().index_status()
+
+    @access.admin(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description(
+            "Report counters of entry processing and schema caching in this process"
+        ).errorResponse("Admin access was denied.", 403)
+    )
+    def getMetrics(self):
+        counts = metrics.snapshot()
+        for key, value in FormModel.materialized_cache_info().items():
+            counts[f"materializedSchemas.{key}"] = value
+        # Uploads run concurrently, so throughput is measured against the wall
+        # time during which any upload ran.
+        if counts.get("gdrive.upload.busyMs"):
+            counts["gdrive.upload.bytesPerSecond"] = round(
+                counts["gdrive.upload.bytes"] * 1000 / counts["gdrive.upload.busyMs"]
+            )
+        return counts
+
+    @access.admin(scope=TokenScope.DATA_READ)
+    @autoDescribeRoute(
+        Description(
+            "Report the number of pending and failed Google Drive uploads"
+        ).errorResponse("Admin access was denied.", 403)
+    )
+    def getDriveSyncStatus(self):
+        return DriveSyncModel().status_counts()
+
     @access.public
     @autoDescribeRoute(
         Description("Get an entry by ID").modelParam(
@@ -1,3 +1,6 @@
+import datetime
+import os
+
 import cherrypy
 from girder.api import access
 from girder.api.describe import Description, autoDescribeRoute
@@ -13,7 +16,10 @@ from girder.models.folder import Folder
 from girder.utility import RequestBodyStream
 from girder.utility.progress import noProgress
 
-from ..models.form import Form as FormModel
+from ..lib.pagination import keyset_params, set_next_page_header
+from ..models.form import ENUM_MODES, Form as FormModel
+
+EXPORT_CHUNK_SIZE = 1024 * 1024
 
 
 class Form(Resource):
@@ -27,12 +33,17 @@ class Form(Resource):
         self.route("DELETE", (":id",), self.deleteForm)
         self.route("GET", (":id", "access"), self.getFromAccess)
         self.route("PUT", (":id", "access"), self.updateFromAccess)
+        self.route("GET", (":id", "enum"), self.listEnumValues)
         self.route("GET", (":id", "export"), self.exportForm)
         self.route("POST", (":id", "import"), self.importForm)
 
     @access.public
     @autoDescribeRoute(
         Description("List all forms")
+        .notes(
+            "Pass the value of the Girder-Next-Page response header as 'after' to "
+            "fetch the following page without skipping over the preceding ones."
+        )
         .param(
             "entryFileName",
             "Pass to lookup a form by exact entry filename match.",
@@ -47,22 +58,35 @@ class Form(Resource):
             default=AccessType.READ,
             enum=[AccessType.NONE, AccessType.READ, AccessType.WRITE, AccessType.ADMIN],
         )
+        .param(
+            "after",
+            "Opaque token of the last form of the previous page",
+            required=False,
+            dataType="string",
+        )
         .pagingParams(defaultSort="name", defaultSortDir=SortDir.ASCENDING)
     )
     @filtermodel(model="form", plugin="jsonforms")
-    def listForm(self, entryFileName, level, limit, offset, sort):
+    def listForm(self, entryFileName, level, after, limit, offset, sort):
+        page, sort, offset = keyset_params(after, sort, offset)
         query = {}
         if entryFileName is not None:
             query["entryFileName"] = entryFileName
+        if page:
+            query = {"$and": [query, page]}
 
-        return FormModel().findWithPermissions(
-            query=query,
-            offset=offset,
-            limit=limit,
-            sort=sort,
-            user=self.getCurrentUser(),
-            level=level,
+        forms = list(
+            FormModel().findWithPermissions(
+                query=query,
+                offset=offset,
+                limit=limit,
+                sort=sort,
+                user=self.getCurrentUser(),
+                level=level,
+            )
         )
+        set_next_page_header(forms, sort, limit)
+        return forms
 
     @access.user(scope=TokenScope.DATA_WRITE)
     @autoDescribeRoute(
@@ -75,11 +99,19 @@ class Form(Resource):
             dataType="boolean",
             default=True,
         )
+        .param(
+            "chunked",
+            "Whether to report only failed rows, keeping memory use bounded for "
+            "large files",
+            required=False,
+            dataType="boolean",
+            default=False,
+        )
         .errorResponse("ID was invalid.")
         .errorResponse("Invalid file format", 400)
         .errorResponse("Write access was denied on the form.", 403)
     )
-    def importForm(self, form, dryRun):
+    def importForm(self, form, dryRun, chunked):
         content_type = cherrypy.request.headers.get("Content-Type")
         if content_type not in (
             "application/csv",
@@ -94,11 +126,18 @@ class Form(Resource):
             raise RestException("File is empty")
         file_obj = RequestBodyStream(cherrypy.request.body)
         file_type = "csv" if content_type == "application/csv" else "xlsx"
-        return FormModel().import_entries(form, file_obj, file_type, dry_run=dryRun)
+        return FormModel().import_entries(
+            form, file_obj, file_type, dry_run=dryRun, chunked=chunked
+        )
 
     @access.public(scope=TokenScope.DATA_READ, cookie=True)
     @autoDescribeRoute(
         Description("Export form entries as a table")
+        .notes(
+            "Entries are read twice: once to collect the columns, including keys "
+            "the schema does not describe, and once to write the rows. The "
+            "download starts after the first pass."
+        )
         .modelParam("id", "The ID of the form", model=FormModel, level=AccessType.READ)
         .param(
             "exportFormat",
@@ -111,28 +150,70 @@ class Form(Resource):
         .errorResponse("Read access was denied on the form.", 403)
     )
     def exportForm(self, form, exportFormat):
-        export = FormModel().export_form(form, exportFormat)
-        setResponseHeader("Content-Length", export.getbuffer().nbytes)
-        content_type = (
-            "text/csv" if exportFormat == "csv" else "application/vnd.ms-excel"
-        )
-        setResponseHeader("Content-Type", content_type)
+        if exportFormat == "csv":
+            chunks = FormModel().iter_csv_export(form)
+            setResponseHeader("Content-Type", "text/csv")
+            setResponseHeader(
+                "Content-Disposition",
+                f"attachment; filename={form['name']}.csv",
+            )
+            setRawResponse()
+
+            def stream():
+                yield from chunks
+
+            return stream
+
+        export = FormModel().xlsx_export(form)
+        setResponseHeader("Content-Length", os.fstat(export.fileno()).st_size)
+        setResponseHeader("Content-Type", "application/vnd.ms-excel")
         setResponseHeader(
             "Content-Disposition",
-            f"attachment; filename={form['name']}." + exportFormat,
+            f"attachment; filename={form['name']}.xlsx",
         )
         setRawResponse()
-        return export.getvalue()
+
+        def stream():
+            with export:
+                while chunk := export.read(EXPORT_CHUNK_SIZE):
+                    yield chunk
+
+        return stream
 
     @access.public
     @autoDescribeRoute(
-        Description("Get a form by ID").modelParam(
-            "id", "The ID of the form", model=FormModel, level=AccessType.READ
+        Description("Get a form by ID")
+        .modelParam("id", "The ID of the form", model=FormModel, level=AccessType.READ)
+        .param(
+            "enumMode",
+            "Whether to inline entries of girder.formId enum sources or to reference "
+            "the enum endpoint of the source form. The remote mode is meant for API "
+            "clients; the bundled web client only renders inline enum sources.",
+            required=False,
+            default="inline",
+            enum=list(ENUM_MODES),
         )
     )
     @filtermodel(model="form", plugin="jsonforms")
-    def getForm(self, form):
-        return FormModel().materialize(form, self.getCurrentUser())
+    def getForm(self, form, enumMode):
+        return FormModel().materialize(form, self.getCurrentUser(), enum_mode=enumMode)
+
+    @access.public
+    @autoDescribeRoute(
+        Description("List values of a form used as an enum source")
+        .modelParam("id", "The ID of the form", model=FormModel, level=AccessType.READ)
+        .param(
+            "prefix",
+            "Only return values whose unique field starts with this string",
+            required=False,
+            dataType="string",
+        )
+        .pagingParams(defaultSort=None)
+        .errorResponse("ID was invalid.")
+        .errorResponse("Read access was denied on the form.", 403)
+    )
+    def listEnumValues(self, form, prefix, limit, offset):
+        return FormModel().enum_values(form, prefix=prefix, limit=limit, offset=offset)
 
     @access.user
     @autoDescribeRoute(
@@ -185,6 +266,14 @@ class Form(Resource):
             dataType="string",
             default="sampleId",
         )
+        .param(
+            "asyncFinalize",
+            "Finalize new entries in the background. Entries are returned with a "
+            "pending status, which changes to complete or failed.",
+            required=False,
+            dataType="boolean",
+            default=False,
+        )
     )
     @filtermodel(model="form", plugin="jsonforms")
     def createForm(
@@ -198,6 +287,7 @@ class Form(Resource):
         gdriveFolderId,
         serialize,
         uniqueField,
+        asyncFinalize,
     ):
         return FormModel().create_form(
             name,
@@ -210,6 +300,7 @@ class Form(Resource):
             gdriveFolderId=gdriveFolderId or None,
             serialize=serialize,
             uniqueField=uniqueField,
+            asyncFinalize=asyncFinalize,
         )
 
     @access.user(scope=TokenScope.DATA_WRITE)
@@ -263,6 +354,12 @@ class Form(Resource):
             required=False,
             dataType="string",
         )
+        .param(
+            "asyncFinalize",
+            "Finalize new entries in the background",
+            required=False,
+            dataType="boolean",
+        )
         .responseClass("Form")
         .errorResponse("ID was invalid.")
         .errorResponse("Write access was denied on the form.", 403)
@@ -279,6 +376,7 @@ class Form(Resource):
         gdriveFolderId,
         serialize,
         uniqueField,
+        asyncFinalize,
     ):
         if name is not None:
             form["name"] = name
@@ -291,6 +389,7 @@ class Form(Resource):
         if folder:
             form["folderId"] = folder["_id"]
         if pathTemplate is not None:
+            FormModel.validate_path_template(form, pathTemplate)
             if not pathTemplate:
                 form["pathTemplate"] = None
             else:
@@ -301,6 +400,9 @@ class Form(Resource):
             form["serialize"] = serialize
         if uniqueField is not None:
             form["uniqueField"] = uniqueField
+        if asyncFinalize is not None:
+            form["asyncFinalize"] = asyncFinalize
+        form["updated"] = datetime.datetime.utcnow()
         return FormModel().save(form)
 
     @access.user
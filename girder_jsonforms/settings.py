@@ -4,6 +4,11 @@ from girder.utility import setting_utilities
 
 class PluginSettings:
     GOOGLE_DRIVE_ENABLED = "jsonforms.google_drive_enabled"
+    REMOTE_SCHEMA = "jsonforms.remote_schema"
+    IMPORT_WORKERS = "jsonforms.import_workers"
+    FINALIZE_WORKERS = "jsonforms.finalize_workers"
+    GDRIVE_UPLOAD_WORKERS = "jsonforms.gdrive_upload_workers"
+    GDRIVE_SYNC_DEBOUNCE = "jsonforms.gdrive_sync_debounce"
 
 
 @setting_utilities.default(PluginSettings.GOOGLE_DRIVE_ENABLED)
@@ -24,3 +29,111 @@ def validate_google_drive_enabled(doc):
             "Google Drive integration must be a boolean.",
             "value",
         )
+
+
+@setting_utilities.default(PluginSettings.REMOTE_SCHEMA)
+def default_remote_schema():
+    """
+    Default caching policy for schemas loaded from a URL (in seconds).
+    """
+    return {"ttl": 300, "staleTtl": 3600, "timeout": 10}
+
+
+@setting_utilities.validator(PluginSettings.REMOTE_SCHEMA)
+def validate_remote_schema(doc):
+    """
+    Validate the remote schema caching policy.
+    """
+    value = doc["value"]
+    if not isinstance(value, dict):
+        raise ValidationException("Remote schema policy must be an object.", "value")
+    for key in ("ttl", "staleTtl", "timeout"):
+        if key not in value:
+            value[key] = default_remote_schema()[key]
+        if (
+            isinstance(value[key], bool)
+            or not isinstance(value[key], (int, float))
+            or value[key] < 0
+        ):
+            raise ValidationException(
+                f"Remote schema {key} must be a non-negative number.", "value"
+            )
+    if value["timeout"] == 0:
+        raise ValidationException("Remote schema timeout must be positive.", "value")
+
+
+@setting_utilities.default(PluginSettings.IMPORT_WORKERS)
+def default_import_workers():
+    """
+    Default number of processes validating imported rows (0 validates serially).
+    """
+    return 0
+
+
+@setting_utilities.validator(PluginSettings.IMPORT_WORKERS)
+def validate_import_workers(doc):
+    """
+    Validate the number of import validation processes.
+    """
+    if isinstance(doc["value"], bool) or not isinstance(doc["value"], int):
+        raise ValidationException("Import workers must be an integer.", "value")
+    if doc["value"] < 0:
+        raise ValidationException("Import workers must not be negative.", "value")
+
+
+@setting_utilities.default(PluginSettings.FINALIZE_WORKERS)
+def default_finalize_workers():
+    """
+    Default number of threads finalizing entries of forms in asynchronous mode.
+    """
+    return 4
+
+
+@setting_utilities.validator(PluginSettings.FINALIZE_WORKERS)
+def validate_finalize_workers(doc):
+    """
+    Validate the number of entry finalization threads.
+    """
+    if isinstance(doc["value"], bool) or not isinstance(doc["value"], int):
+        raise ValidationException("Finalize workers must be an integer.", "value")
+    if doc["value"] < 1:
+        raise ValidationException("Finalize workers must be positive.", "value")
+
+
+@setting_utilities.default(PluginSettings.GDRIVE_UPLOAD_WORKERS)
+def default_gdrive_upload_workers():
+    """
+    Default number of concurrent Google Drive uploads.
+    """
+    return 4
+
+
+@setting_utilities.validator(PluginSettings.GDRIVE_UPLOAD_WORKERS)
+def validate_gdrive_upload_workers(doc):
+    """
+    Validate the number of concurrent Google Drive uploads.
+    """
+    if isinstance(doc["value"], bool) or not isinstance(doc["value"], int):
+        raise ValidationException("Drive upload workers must be an integer.", "value")
+    if doc["value"] < 1:
+        raise ValidationException("Drive upload workers must be positive.", "value")
+
+
+@setting_utilities.default(PluginSettings.GDRIVE_SYNC_DEBOUNCE)
+def default_gdrive_sync_debounce():
+    """
+    Default delay before a Google Drive upload starts (in seconds). Writes to the
+    same file within it are coalesced into a single upload.
+    """
+    return 10
+
+
+@setting_utilities.validator(PluginSettings.GDRIVE_SYNC_DEBOUNCE)
+def validate_gdrive_sync_debounce(doc):
+    """
+    Validate the Google Drive upload debounce delay.
+    """
+    if isinstance(doc["value"], bool) or not isinstance(doc["value"], int | float):
+        raise ValidationException("Drive sync debounce must be a number.", "value")
+    if doc["value"] < 0:
+        raise ValidationException("Drive sync debounce must not be negative.", "value")
@@ -0,0 +1,40 @@
+from ..lib.cache import LRUCache
+
+
+def test_lru_eviction():
+    cache = LRUCache(maxsize=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    assert cache.get("c") == 3
+    assert cache.info()["evictions"] == 1
+
+
+def test_lru_counters():
+    cache = LRUCache()
+    assert cache.get("missing") is None
+    cache.set("key", "value")
+    assert cache.get("key") == "value"
+    info = cache.info()
+    assert info["hits"] == 1
+    assert info["misses"] == 1
+
+
+def test_lru_validate():
+    cache = LRUCache()
+    cache.set("key", {"version": 1})
+    assert cache.get("key", validate=lambda v: v["version"] == 1) == {"version": 1}
+    assert cache.get("key", validate=lambda v: v["version"] == 2) is None
+    assert "key" not in cache
+    assert cache.info()["misses"] == 1
+
+
+def test_lru_discard():
+    cache = LRUCache()
+    for i in range(5):
+        cache.set(i, i % 2)
+    assert cache.discard(lambda key, value: value == 1) == 2
+    assert len(cache) == 3
@@ -0,0 +1,70 @@
+import pytest
+from bson import ObjectId
+
+
+@pytest.mark.plugin("jsonforms")
+def test_drive_sync_outbox(server, admin):
+    from girder_jsonforms.models.drive_sync import MAX_ATTEMPTS, DriveSync
+
+    outbox = DriveSync()
+    file = {"_id": ObjectId()}
+    for _ in range(3):
+        outbox.enqueue(file, "root", "a/entry.json", admin)
+    outbox.enqueue(file, "root", "b/entry.json", admin, delay=60)
+    assert outbox.status_counts() == {"pending": 2, "active": 0, "failed": 0}
+
+    # Repeated writes are coalesced, and uploads are only due after the delay.
+    (sync,) = outbox.claim(10)
+    assert sync["path"] == "a/entry.json" and sync["version"] == 3
+    assert outbox.claim(10) == []
+    assert outbox.status_counts()["active"] == 1
+
+    # A write while uploading keeps the newer version queued.
+    outbox.enqueue(file, "root", "a/entry.json", admin)
+    outbox.complete(sync)
+    (sync,) = outbox.claim(10)
+    assert sync["version"] == 4
+    outbox.complete(sync)
+    assert outbox.status_counts()["pending"] == 1
+
+    sync = outbox.findOne({"path": "b/entry.json"})
+    for _ in range(MAX_ATTEMPTS):
+        outbox.fail(sync, ValueError("quota exceeded"))
+        sync = outbox.findOne({"_id": sync["_id"]})
+    assert sync["error"] == "quota exceeded"
+    assert outbox.status_counts() == {"pending": 0, "active": 0, "failed": 1}
+
+
+@pytest.mark.plugin("jsonforms")
+def test_entry_uploads_queued(server, admin, fsAssetstore):
+    from girder.models.folder import Folder
+    from girder.models.setting import Setting
+
+    from girder_jsonforms.models.drive_sync import DriveSync
+    from girder_jsonforms.models.entry import FormEntry
+    from girder_jsonforms.models.form import Form
+    from girder_jsonforms.settings import PluginSettings
+
+    form = Form().create_form(
+        "form",
+        "",
+        "{}",
+        admin,
+        uniqueField="sampleId",
+        serialize=True,
+        gdriveFolderId="root",
+    )
+    destination = Folder().createFolder(admin, "dest", parentType="user", creator=admin)
+    data = {"sampleId": "S1", "targetPath": "S1"}
+    FormEntry().create_entry(form, data, None, destination, admin)
+    assert DriveSync().status_counts()["pending"] == 0
+
+    # The snapshot upload is in the outbox once the entry is saved.
+    Setting().set(PluginSettings.GOOGLE_DRIVE_ENABLED, True)
+    try:
+        FormEntry().create_entry(form, data, None, destination, admin)
+    finally:
+        Setting().set(PluginSettings.GOOGLE_DRIVE_ENABLED, False)
+    (sync,) = DriveSync().find()
+    assert (sync["rootId"], sync["path"]) == ("root", "S1/entry.json")
+    assert sync["userId"] == admin["_id"]
@@ -0,0 +1,407 @@
+import datetime
+import io
+import json
+
+import pytest
+from pytest_girder.assertions import assertStatusOk
+
+from ..models import entry as entry_module
+from ..models.entry import UNIQUE_INDEX_PREFIX, FormEntry
+
+
+def test_list_projection():
+    assert FormEntry.list_projection() is None
+    assert FormEntry.list_projection(
+        fields=["sampleId", "meta", "meta.date"], sort=[("created", 1), ("_id", 1)]
+    ) == {
+        "_id": 1,
+        "formId": 1,
+        "created": 1,
+        "updated": 1,
+        "data.sampleId": 1,
+        "data.meta": 1,
+    }
+
+
+def test_list_projection_summary():
+    form = {"uniqueField": "barcode"}
+    projection = FormEntry.list_projection(
+        form, fields=["ignored"], summary=True, sort=[("data.barcode", -1)]
+    )
+    assert sorted(projection) == ["_id", "created", "data.barcode", "formId", "updated"]
+    assert "data.sampleId" in FormEntry.list_projection(summary=True)
+
+
+@pytest.mark.parametrize("field", ["", "a..b", "$where", "a."])
+def test_list_projection_invalid(field):
+    with pytest.raises(ValueError):
+        FormEntry.list_projection(fields=[field])
+
+
+def test_snapshot_hash_ignores_updated():
+    entry = {"data": {"sampleId": "S1"}, "created": 1, "updated": 1, "files": []}
+    same = dict(entry, updated=2)
+    assert FormEntry.snapshot_hash(entry) == FormEntry.snapshot_hash(same)
+    assert FormEntry.snapshot_hash(entry) != FormEntry.snapshot_hash(
+        dict(entry, files=["a"])
+    )
+
+
+@pytest.mark.plugin("jsonforms")
+def test_destination_folder_cache(server, admin):
+    from girder.models.folder import Folder
+
+    root = Folder().createFolder(admin, "root", parentType="user", creator=admin)
+    other = Folder().createFolder(admin, "other", parentType="user", creator=admin)
+    leaf = FormEntry.get_destination_folder("a/b/c", root, admin)
+    assert FormEntry.get_destination_folder("a/b/c", root, admin)["_id"] == leaf["_id"]
+
+    # Moving a folder along the cached path creates the path anew.
+    middle = Folder().load(leaf["parentId"], force=True)
+    Folder().move(middle, other, "folder")
+    moved = FormEntry.get_destination_folder("a/b/c", root, admin)
+    assert moved["_id"] != leaf["_id"]
+    assert Folder().load(moved["parentId"], force=True)["parentId"] != other["_id"]
+
+
+@pytest.mark.plugin("jsonforms")
+def test_unique_names(server, admin):
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+
+    dest = Folder().createFolder(admin, "dest", parentType="user", creator=admin)
+    source = Folder().createFolder(admin, "source", parentType="user", creator=admin)
+    other = Folder().createFolder(admin, "other", parentType="user", creator=admin)
+    for name in ("img.tif", "img.tif (1)", "img.tif (3)", "img.tiff"):
+        Item().createItem(name, admin, dest)
+    Folder().createFolder(dest, "sub", creator=admin)
+    children = [
+        Item().createItem("img.tif", admin, source),
+        Folder().createFolder(other, "img.tif", creator=admin),
+        Item().createItem("sub", admin, source),
+    ]
+    assert [child["name"] for child in FormEntry.unique_names(children, dest)] == [
+        "img.tif (2)",
+        "img.tif (4)",
+        "sub (1)",
+    ]
+
+
+def unique_indexes():
+    return {
+        index["name"]
+        for index in FormEntry().collection.list_indexes()
+        if index["name"].startswith(UNIQUE_INDEX_PREFIX)
+    }
+
+
+@pytest.mark.plugin("jsonforms")
+def test_unique_field_indexes(server, admin, monkeypatch):
+    from ..models.form import Form
+
+    # Indexes created for an earlier test database are gone.
+    monkeypatch.setattr(entry_module, "_unique_field_indices", set())
+    form = Form().create_form("form", "", "{}", admin, uniqueField="barcode")
+    assert unique_indexes() == {UNIQUE_INDEX_PREFIX + "barcode"}
+
+    form["uniqueField"] = "sampleId"
+    form = Form().save(form)
+    assert unique_indexes() == {UNIQUE_INDEX_PREFIX + "sampleId"}
+    # Search keys are recomputed in the background.
+    from girder_jsonforms import BACKFILLS
+
+    BACKFILLS.submit(lambda: None).result()
+    assert Form().load(form["_id"], force=True)["indexedUniqueField"] == "sampleId"
+
+    keys, options = FormEntry.unique_field_index("old")
+    FormEntry().collection.create_index(keys, **options)
+    resp = server.request("/entry/index", user=admin)
+    assertStatusOk(resp)
+    status = {index["name"]: index for index in resp.json}
+    assert all(index["present"] for index in status.values())
+    assert status[UNIQUE_INDEX_PREFIX + "sampleId"]["required"]
+    assert status[UNIQUE_INDEX_PREFIX + "sampleId"]["key"] == {
+        "formId": 1,
+        "data.sampleId": 1,
+    }
+    assert not status[UNIQUE_INDEX_PREFIX + "old"]["required"]
+    assert status["formId_1_lowerUniqueValue_1"]["required"]
+
+    Form().remove(form)
+    assert unique_indexes() == set()
+
+
+@pytest.mark.plugin("jsonforms")
+def test_prefix_search(server, admin):
+    from ..models.form import Form
+
+    form = Form().create_form("form", "", "{}", admin, uniqueField="sampleId")
+    other = Form().create_form("other", "", "{}", admin, uniqueField="sampleId")
+    now = datetime.datetime.utcnow()
+    for owner, sample_id in (
+        (form, "ABC-1"),
+        (form, "abd-2"),
+        (form, "x-abc"),
+        (form, "Straße"),
+        (other, "abc-3"),
+    ):
+        FormEntry().save(
+            {
+                "formId": owner["_id"],
+                "data": {"sampleId": sample_id},
+                "created": now,
+                "updated": now,
+            }
+        )
+    FormEntry().save(
+        {"formId": form["_id"], "data": {}, "created": now, "updated": now}
+    )
+
+    # Entries saved without a search key are backfilled.
+    FormEntry().update_lower_unique_values(form)
+    lower = {
+        entry["data"].get("sampleId"): entry["lowerUniqueValue"]
+        for entry in FormEntry().find({"formId": form["_id"]})
+    }
+    assert lower == {
+        "ABC-1": "abc-1",
+        "abd-2": "abd-2",
+        "x-abc": "x-abc",
+        "Straße": "strasse",
+        None: None,
+    }
+    assert Form().load(form["_id"], force=True)["indexedUniqueField"] == "sampleId"
+
+    def search(query, **kwargs):
+        return sorted(
+            entry["data"]["sampleId"]
+            for entry in FormEntry().search(form, query, **kwargs)
+        )
+
+    assert search("ab") == ["ABC-1", "abd-2"]
+    assert search("aBc") == ["ABC-1"]
+    assert search("STRASS") == ["Straße"]
+    assert search("a.c") == []
+    assert search("abc", regex=True) == ["x-abc"]
+
+    resp = server.request(
+        "/entry/search", user=admin, params={"query": "AB", "formId": form["_id"]}
+    )
+    assertStatusOk(resp)
+    assert sorted(entry["data"]["sampleId"] for entry in resp.json) == [
+        "ABC-1",
+        "abd-2",
+    ]
+
+
+@pytest.mark.plugin("jsonforms")
+def test_move_items(server, admin, fsAssetstore):
+    from girder import events
+    from girder.models.collection import Collection
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+    from girder.models.upload import Upload
+    from girder.models.user import User
+
+    collection = Collection().createCollection("dest", admin)
+    dest = Folder().createFolder(collection, "dest", parentType="collection")
+    source = Folder().createFolder(admin, "source", parentType="user", creator=admin)
+    Item().createItem("a.txt", admin, dest)
+    for name, content in (("a.txt", b"abc"), ("b.txt", b"12345"), ("veto", b"xy")):
+        Upload().uploadFromFile(
+            io.BytesIO(content),
+            len(content),
+            name,
+            parentType="folder",
+            parent=source,
+            user=admin,
+        )
+    user_size = User().load(admin["_id"], force=True)["size"]
+    items = list(Folder().childItems(source))
+    FormEntry.unique_names(items, dest)
+
+    def veto(event):
+        if event.info["name"] == "veto":
+            event.preventDefault()
+
+    validated = []
+    saved = []
+    with (
+        events.bound(
+            "model.item.validate", "test", lambda event: validated.append(event.info)
+        ),
+        events.bound("model.item.save", "test", veto),
+        events.bound(
+            "model.item.save.after", "test", lambda event: saved.append(event.info)
+        ),
+    ):
+        moved = FormEntry.move_items([(item, dest) for item in items])
+    assert sorted(item["name"] for item in moved) == ["a.txt (1)", "b.txt"]
+    assert [item["_id"] for item in validated] == [item["_id"] for item in items]
+    assert [item["_id"] for item in saved] == [item["_id"] for item in moved]
+
+    for item in moved:
+        stored = Item().load(item["_id"], force=True)
+        assert stored["name"] == item["name"]
+        assert stored["folderId"] == dest["_id"]
+        assert stored["baseParentType"] == "collection"
+        assert stored["baseParentId"] == collection["_id"]
+        assert stored["updated"] > stored["created"]
+    (vetoed,) = Folder().childItems(source)
+    assert vetoed["name"] == "veto"
+
+    assert Folder().load(source["_id"], force=True)["size"] == 2
+    assert Folder().load(dest["_id"], force=True)["size"] == 8
+    assert Collection().load(collection["_id"], force=True)["size"] == 8
+    assert User().load(admin["_id"], force=True)["size"] == user_size - 8
+
+
+class DeferredExecutor:
+    def __init__(self):
+        self.jobs = []
+
+    def submit(self, fn, *args):
+        self.jobs.append((fn, args))
+
+    def run(self):
+        while self.jobs:
+            fn, args = self.jobs.pop(0)
+            fn(*args)
+
+
+@pytest.fixture
+def async_form(admin, fsAssetstore, monkeypatch):
+    from girder.models.folder import Folder
+    from girder.models.upload import Upload
+
+    from ..models.form import Form
+
+    executor = DeferredExecutor()
+    monkeypatch.setattr(entry_module, "_finalize_executor", lambda: executor)
+    form = Form().create_form(
+        "form", "", "{}", admin, uniqueField="sampleId", asyncFinalize=True
+    )
+    destination = Folder().createFolder(admin, "dest", parentType="user", creator=admin)
+
+    def create_entry(sample_id):
+        source = Folder().createFolder(
+            admin, sample_id, parentType="user", creator=admin
+        )
+        upload = Upload().uploadFromFile(
+            io.BytesIO(b"abc"),
+            3,
+            f"{sample_id}.txt",
+            parentType="folder",
+            parent=source,
+            user=admin,
+        )
+        entry = FormEntry().create_entry(
+            form, {"sampleId": sample_id}, source, destination, admin
+        )
+        return entry, upload["itemId"]
+
+    return executor, destination, create_entry
+
+
+@pytest.mark.plugin("jsonforms")
+def test_async_finalize(server, admin, async_form, monkeypatch):
+    from bson import ObjectId
+
+    executor, destination, create_entry = async_form
+    entry, item_id = create_entry("S1")
+    assert entry["status"] == entry_module.ENTRY_PENDING
+    assert entry["finalize"]["destinationId"] == destination["_id"]
+
+    # A file attached while the entry is finalized is kept.
+    attached = ObjectId()
+    FormEntry().update({"_id": entry["_id"]}, {"$push": {"files": attached}})
+    executor.run()
+    stored = FormEntry().load(entry["_id"], force=True)
+    assert stored["status"] == entry_module.ENTRY_COMPLETE
+    assert stored["error"] is None
+    assert "finalize" not in stored
+    assert sorted(stored["files"]) == sorted([attached, item_id])
+    assert entry["status"] == entry_module.ENTRY_PENDING
+
+    def fail(*args):
+        raise ValueError("disk full")
+
+    monkeypatch.setattr(FormEntry, "unique_names", staticmethod(fail))
+    entry, _ = create_entry("S2")
+    executor.run()
+    stored = FormEntry().load(entry["_id"], force=True)
+    assert stored["status"] == entry_module.ENTRY_FAILED
+    assert stored["error"] == "disk full"
+
+
+@pytest.mark.plugin("jsonforms")
+def test_resume_pending(server, admin, async_form):
+    from girder.models.folder import Folder
+    from girder.models.item import Item
+
+    executor, destination, create_entry = async_form
+    entry, item_id = create_entry("S1")
+    orphan, _ = create_entry("S2")
+    FormEntry().update({"_id": orphan["_id"]}, {"$set": {"finalize.creatorId": None}})
+
+    # Entries are not resumed while the process that queued them holds them.
+    FormEntry().resume_pending()
+    assert len(executor.jobs) == 2
+
+    # That process stopped, or is too slow, so the leases expire.
+    expired = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+    FormEntry().update({}, {"$set": {"finalize.leaseUntil": expired}})
+    FormEntry().resume_pending()
+    FormEntry().resume_pending()
+    assert len(executor.jobs) == 3
+    executor.run()
+    stored = FormEntry().load(entry["_id"], force=True)
+    assert stored["status"] == entry_module.ENTRY_COMPLETE
+    assert stored["files"] == [item_id]
+    assert Item().load(item_id, force=True)["folderId"] == destination["_id"]
+    assert Folder().load(entry["finalize"]["sourceId"], force=True) is None
+    stored = FormEntry().load(orphan["_id"], force=True)
+    assert stored["status"] == entry_module.ENTRY_FAILED
+    assert "finalize" not in stored
+
+    status = {index["name"]: index for index in FormEntry().index_status()}
+    assert status["status_1"]["present"]
+    assert status["status_1"]["partialFilterExpression"] == {
+        "status": entry_module.ENTRY_PENDING
+    }
+
+
+@pytest.mark.plugin("jsonforms")
+def test_snapshot_rewritten_after_replace(server, admin, fsAssetstore):
+    from girder.models.file import File
+    from girder.models.folder import Folder
+    from girder.models.upload import Upload
+
+    from ..lib.metrics import metrics
+    from ..models.form import Form
+
+    form = Form().create_form(
+        "form", "", "{}", admin, uniqueField="sampleId", serialize=True
+    )
+    destination = Folder().createFolder(admin, "dest", parentType="user", creator=admin)
+    metrics.reset()
+
+    def create_entry():
+        FormEntry().create_entry(form, {"sampleId": "S1"}, None, destination, admin)
+        _, file = FormEntry._find_entry_file(form["entryFileName"], destination)
+        with File().open(file) as fh:
+            return json.load(fh)
+
+    assert create_entry()["data"] == {"sampleId": "S1"}
+    # The first snapshot was written before the entry had an id.
+    create_entry()
+    create_entry()
+    assert metrics.snapshot()["snapshots.skipped"] == 1
+
+    # Replacing the content in place invalidates the stored hash.
+    _, file = FormEntry._find_entry_file(form["entryFileName"], destination)
+    upload = Upload().createUploadToFile(file, admin, 2)
+    Upload().handleChunk(upload, io.BytesIO(b"{}"))
+    assert create_entry()["data"] == {"sampleId": "S1"}
+    counts = metrics.snapshot()
+    assert (counts["snapshots.written"], counts["snapshots.skipped"]) == (3, 1)
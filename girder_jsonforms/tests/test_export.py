@@ -0,0 +1,74 @@
+import io
+
+import openpyxl
+import pytest
+
+from ..lib.export import iter_csv, measure_arrays, table_columns, to_cell, write_xlsx
+from ..lib.jq import convert_to_jq_notation
+
+
+@pytest.fixture
+def column_types():
+    return {
+        "data.sampleId": "object",
+        "data.list": "array",
+        "data.list[].name": "object",
+        "data.list[].tags": "array",
+        "data.count": "int64",
+    }
+
+
+@pytest.fixture
+def entries():
+    return [
+        {"data": {"sampleId": "A", "list": [{"name": "x", "tags": ["a", "b"]}]}},
+        {"data": {"sampleId": "B", "list": [{"name": "y"}, {"name": "z"}], "count": 2}},
+    ]
+
+
+def test_measure_arrays(entries):
+    lengths = {}
+    for entry in entries:
+        measure_arrays(convert_to_jq_notation(entry), lengths)
+    assert lengths == {"data.list": 2, "data.list[].tags": 2}
+
+
+def test_table_columns(column_types):
+    lengths = {"data.list": 2, "data.list[].tags": 1}
+    assert table_columns(column_types, lengths) == [
+        "data.sampleId",
+        "data.list.[0].name",
+        "data.list.[0].tags.[0]",
+        "data.list.[1].name",
+        "data.list.[1].tags.[0]",
+        "data.count",
+    ]
+
+
+def test_iter_csv(entries):
+    columns = ["data.sampleId", "data.list.[1].name", "data.count"]
+    chunks = list(
+        iter_csv(columns, map(convert_to_jq_notation, entries), batch_size=1)
+    )
+    assert len(chunks) == 2
+    assert b"".join(chunks).decode() == (
+        "data.sampleId,data.list.[1].name,data.count\nA,,\nB,z,2\n"
+    )
+
+
+def test_to_cell():
+    assert to_cell("3", "int64") == 3
+    assert to_cell("1.5", "float64") == 1.5
+    assert to_cell("false", "bool") is False
+    assert to_cell("n/a", "int64") == "n/a"
+    assert to_cell("", "object") is None
+    assert to_cell(["a"]) == "['a']"
+
+
+def test_write_xlsx(entries):
+    columns = ["data.sampleId", "data.count"]
+    fh = io.BytesIO()
+    write_xlsx(columns, {"data.count": "int64"}, map(convert_to_jq_notation, entries), fh)
+    fh.seek(0)
+    rows = list(openpyxl.load_workbook(fh).active.iter_rows(values_only=True))
+    assert rows == [("data.sampleId", "data.count"), ("A", None), ("B", 2)]
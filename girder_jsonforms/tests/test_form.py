@@ -0,0 +1,249 @@
+import csv
+import datetime
+import io
+import json
+
+import openpyxl
+import pytest
+from girder.constants import AccessType
+from girder.exceptions import ValidationException
+from pytest_girder.assertions import assertStatusOk
+
+from ..models import form as form_module
+from ..models.entry import FormEntry
+from ..models.form import ENUM_SOURCE_PREFIX, Form
+
+
+def add_entry(form, **data):
+    now = datetime.datetime.utcnow()
+    return FormEntry().save(
+        {"formId": form["_id"], "data": data, "created": now, "updated": now}
+    )
+
+
+def enum_titles(form, user):
+    schema = Form().materialize(dict(form), user)["schema"]
+    (enum_source,) = schema["properties"]["sample"]["enumSource"]
+    return [item["title"] for item in enum_source["source"]]
+
+
+@pytest.fixture
+def forms(admin):
+    source = Form().create_form(
+        "source", "", json.dumps({"type": "object"}), admin, uniqueField="name"
+    )
+    schema = {
+        "type": "object",
+        "properties": {
+            "sample": {
+                "type": "string",
+                "enumSource": f"{ENUM_SOURCE_PREFIX}{source['_id']}",
+            }
+        },
+    }
+    form = Form().create_form("form", "", json.dumps(schema), admin)
+    return source, form
+
+
+@pytest.mark.plugin("jsonforms")
+def test_materialized_cache(server, admin, forms):
+    source, form = forms
+    first = add_entry(source, name="a")
+    add_entry(source, name="b")
+
+    def misses():
+        return Form.materialized_cache_info()["misses"]
+
+    assert enum_titles(form, admin) == ["a", "b"]
+    before = misses()
+    assert enum_titles(form, admin) == ["a", "b"]
+    assert misses() == before
+
+    # Saving the form, or saving or removing an entry of the source form,
+    # rebuilds the schema.
+    form = Form().save(form)
+    assert enum_titles(form, admin) == ["a", "b"]
+    assert misses() == before + 1
+
+    add_entry(source, name="c")
+    assert enum_titles(form, admin) == ["a", "b", "c"]
+    assert misses() == before + 2
+
+    FormEntry().remove(first)
+    assert enum_titles(form, admin) == ["b", "c"]
+    assert misses() == before + 3
+    assert enum_titles(form, admin) == ["b", "c"]
+    assert misses() == before + 3
+
+    resp = server.request("/entry/metrics", user=admin)
+    assertStatusOk(resp)
+    assert resp.json["materializedSchemas.misses"] == misses()
+
+
+@pytest.mark.plugin("jsonforms")
+def test_enum_values(server, admin, forms):
+    source, form = forms
+    for name in ("B2", "a1", "b1", "c1"):
+        add_entry(source, name=name)
+    add_entry(source, other="no name")
+    path = f"/form/{source['_id']}/enum"
+
+    resp = server.request(path, user=admin)
+    assertStatusOk(resp)
+    assert [value["title"] for value in resp.json] == ["B2", "a1", "b1", "c1"]
+    names = {value["value"]: value["title"] for value in resp.json}
+
+    resp = server.request(path, user=admin, params={"prefix": "b"})
+    assertStatusOk(resp)
+    assert [value["title"] for value in resp.json] == ["b1"]
+
+    resp = server.request(path, user=admin, params={"limit": 2, "offset": 1})
+    assertStatusOk(resp)
+    assert [names[value["value"]] for value in resp.json] == ["a1", "b1"]
+
+    resp = server.request(
+        f"/form/{form['_id']}", user=admin, params={"enumMode": "remote"}
+    )
+    assertStatusOk(resp)
+    schema = resp.json["schema"]
+    assert schema["properties"]["sample"]["enumSource"] == [
+        {
+            "source": [],
+            "remote": path.lstrip("/"),
+            "title": "{{item.title}}",
+            "value": "{{item.value}}",
+        }
+    ]
+
+
+@pytest.mark.plugin("jsonforms")
+def test_export_keeps_undescribed_keys(server, admin):
+    schema = {
+        "type": "object",
+        "properties": {
+            "sampleId": {"type": "string"},
+            "list": {
+                "type": "array",
+                "items": {"type": "object", "properties": {"name": {"type": "string"}}},
+            },
+        },
+    }
+    form = Form().create_form("form", "", json.dumps(schema), admin)
+    add_entry(form, sampleId="A", list=[{"name": "x"}, {"name": "y"}], extra=1)
+    add_entry(form, sampleId="B", targetPath="B/raw", list=[{"name": "z", "n": 2}])
+
+    columns = [
+        "_id",
+        "data.sampleId",
+        "data.list.[0].name",
+        "data.list.[1].name",
+        "data.extra",
+        "data.targetPath",
+        "data.list.[0].n",
+    ]
+    assert Form().export_columns(form) == columns
+
+    rows = list(
+        csv.reader(io.StringIO(b"".join(Form().iter_csv_export(form)).decode()))
+    )
+    assert rows[0] == columns
+    assert [row[1:] for row in rows[1:]] == [
+        ["A", "x", "y", "1", "", ""],
+        ["B", "z", "", "", "B/raw", "2"],
+    ]
+
+    with Form().xlsx_export(form) as fh:
+        sheet = openpyxl.load_workbook(fh).active
+        rows = list(sheet.iter_rows(values_only=True))
+    assert list(rows[0]) == columns
+    assert rows[2][1:] == ("B", "z", None, None, "B/raw", 2)
+
+
+@pytest.fixture
+def import_form(admin, monkeypatch):
+    monkeypatch.setattr(form_module, "IMPORT_BATCH_SIZE", 2)
+    schema = {
+        "type": "object",
+        "properties": {
+            "name": {"type": "string"},
+            "count": {"type": "integer", "minimum": 0},
+        },
+    }
+    form = Form().create_form("form", "", json.dumps(schema), admin, uniqueField="name")
+    add_entry(form, name="old", count=1)
+    return form
+
+
+# Batches of two rows: a repeated id across batches, a row failing validation,
+# and a repeated id within a batch.
+IMPORT_CSV = b"data.name,data.count\nold,2\nnew,3\nnew,4\nbad,-1\ndup,5\ndup,6\n"
+IMPORT_STATUSES = ["updated", "new", "updated", "failed", "new", "updated"]
+
+
+@pytest.mark.plugin("jsonforms")
+def test_import_dry_run(server, admin, import_form, monkeypatch):
+    queries = []
+    find = FormEntry.find
+
+    def counting_find(self, query=None, *args, **kwargs):
+        queries.append(query)
+        return find(self, query, *args, **kwargs)
+
+    monkeypatch.setattr(FormEntry, "find", counting_find)
+    summary = Form().import_entries(import_form, io.BytesIO(IMPORT_CSV), "csv")
+    assert [row["status"] for row in summary["rows"]] == IMPORT_STATUSES
+    assert [row["row"] for row in summary["rows"]] == [1, 2, 3, 4, 5, 6]
+    assert "-1" in summary["rows"][3]["error"]
+    assert (summary["new"], summary["updated"], summary["failed"]) == (2, 3, 1)
+    # One classification query per batch, and nothing written.
+    assert len(queries) == 3
+    assert all("$in" in query["data.name"] for query in queries)
+    monkeypatch.undo()
+    assert FormEntry().collection.count_documents({"formId": import_form["_id"]}) == 1
+
+
+@pytest.mark.plugin("jsonforms")
+def test_import_upserts(server, admin, import_form):
+    summary = Form().import_entries(
+        import_form, io.BytesIO(IMPORT_CSV), "csv", dry_run=False
+    )
+    rows = summary["rows"]
+    assert [row["status"] for row in rows] == IMPORT_STATUSES
+    assert rows[1]["_id"] == rows[2]["_id"]
+    assert rows[4]["_id"] == rows[5]["_id"]
+    assert "_id" not in rows[3]
+
+    entries = {
+        entry["data"]["name"]: entry
+        for entry in FormEntry().find({"formId": import_form["_id"]})
+    }
+    assert sorted(entries) == ["dup", "new", "old"]
+    assert entries["old"]["data"]["count"] == 2
+    assert entries["new"]["data"]["count"] == 4
+    assert entries["dup"]["_id"] == rows[4]["_id"]
+    assert entries["dup"]["data"]["count"] == 6
+    assert entries["dup"]["lowerUniqueValue"] == "dup"
+
+
+@pytest.mark.plugin("jsonforms")
+def test_legacy_path_template(server, admin):
+    form = Form().create_form("form", "", json.dumps({"type": "object"}), admin)
+    legacy = "{data.get('sampleId')}"
+    Form().update({"_id": form["_id"]}, {"$set": {"pathTemplate": legacy}}, multi=False)
+    form = Form().load(form["_id"], force=True)
+
+    # Unrelated saves keep the template, only new templates are checked.
+    form = Form().setUserAccess(form, admin, AccessType.ADMIN, save=True)
+    form = Form().update_form(form, "renamed", "", form["schema"], pathTemplate=legacy)
+    assert form["pathTemplate"] == legacy
+    with pytest.raises(ValidationException):
+        Form().update_form(form, "renamed", "", form["schema"], pathTemplate="{x}")
+
+    resp = server.request(
+        f"/form/{form['_id']}",
+        method="PUT",
+        user=admin,
+        params={"name": "renamed", "pathTemplate": "{data['a'].format(1)}"},
+    )
+    assert resp.status == "400 Bad Request"
+    assert Form().load(form["_id"], force=True)["pathTemplate"] == legacy
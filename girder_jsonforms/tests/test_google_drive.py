@@ -0,0 +1,340 @@
+import datetime
+import hashlib
+import io
+import re
+import threading
+import time
+from collections import Counter
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from ..lib import google_drive
+from ..lib.google_drive import (
+    DriveClient,
+    DriveFolderCache,
+    DriveUploadPool,
+    create_folders,
+    resolve_upload_targets,
+    upload_file_to_gdrive,
+    with_backoff,
+)
+from ..lib.metrics import metrics
+
+FOLDER = "application/vnd.google-apps.folder"
+
+
+class FakeRequest:
+    def __init__(self, drive, call):
+        self._drive = drive
+        self._call = call
+
+    def execute(self):
+        if self._drive.failures:
+            status = self._drive.failures.pop(0)
+            raise HttpError(httplib2.Response({"status": status}), b"")
+        return self._call()
+
+    def next_chunk(self):
+        return None, self.execute()
+
+
+class FakeDrive:
+    """In-memory stand-in for the parts of the Drive v3 service the plugin uses."""
+
+    def __init__(self):
+        self.files_by_id = {"root": {"id": "root", "name": "", "parents": []}}
+        self.calls = Counter()
+        # Statuses of the errors raised by the next requests.
+        self.failures = []
+        self.page_size = 100
+
+    def files(self):
+        return self
+
+    def _check_parent(self, parent):
+        if parent not in self.files_by_id:
+            raise HttpError(httplib2.Response({"status": 404}), b"File not found")
+
+    def _new(self, body, media_body=None):
+        self._check_parent(body["parents"][0])
+        file_id = f"id{len(self.files_by_id)}"
+        self.files_by_id[file_id] = dict(body, id=file_id)
+        if media_body is not None:
+            self._write(file_id, media_body)
+        return {"id": file_id}
+
+    def _write(self, file_id, media_body):
+        content = media_body.getbytes(0, media_body.size())
+        self.files_by_id[file_id].update(
+            content=content,
+            md5Checksum=hashlib.md5(content).hexdigest(),
+            size=str(len(content)),
+        )
+
+    def list(self, q, fields=None, pageSize=100, pageToken=None, **kwargs):
+        def call():
+            self.calls["list"] += 1
+            parent = re.search(r"'([^']*)' in parents", q).group(1)
+            self._check_parent(parent)
+            name = re.search(r"name='([^']*)'", q)
+            files = [
+                {
+                    key: f[key]
+                    for key in ("id", "name", "md5Checksum", "size")
+                    if key in f
+                }
+                for f in self.files_by_id.values()
+                if parent in f["parents"]
+                and (name is None or f["name"] == name.group(1))
+                and (f"mimeType='{FOLDER}'" not in q or f.get("mimeType") == FOLDER)
+                and (f"mimeType!='{FOLDER}'" not in q or f.get("mimeType") != FOLDER)
+            ]
+            start = int(pageToken or 0)
+            end = start + min(pageSize, self.page_size)
+            response = {"files": files[start:end]}
+            if end < len(files):
+                response["nextPageToken"] = str(end)
+            return response
+
+        return FakeRequest(self, call)
+
+    def create(self, body, media_body=None, fields=None, **kwargs):
+        def call():
+            self.calls["create"] += 1
+            return self._new(body, media_body)
+
+        return FakeRequest(self, call)
+
+    def update(self, fileId, media_body=None, **kwargs):
+        def call():
+            self.calls["update"] += 1
+            self._write(fileId, media_body)
+            return {"id": fileId}
+
+        return FakeRequest(self, call)
+
+    def remove(self, file_id):
+        """Delete a file and everything below it, as if done by another client."""
+        del self.files_by_id[file_id]
+        for child in [
+            f["id"] for f in self.files_by_id.values() if file_id in f["parents"]
+        ]:
+            self.remove(child)
+
+
+class DictStore:
+    def __init__(self):
+        self.folders = {}
+
+    def lookup(self, root_id, path):
+        return self.folders.get((root_id, path))
+
+    def record(self, root_id, path, folder_id):
+        self.folders[root_id, path] = folder_id
+
+    def forget(self, root_id, path):
+        for key in list(self.folders):
+            if key[0] == root_id and (key[1] == path or key[1].startswith(path + "/")):
+                del self.folders[key]
+
+
+@pytest.fixture
+def drive(monkeypatch):
+    monkeypatch.setattr(google_drive.time, "sleep", lambda delay: None)
+    return FakeDrive()
+
+
+def test_create_folders_cached(drive):
+    store = DictStore()
+    cache = DriveFolderCache(store=store)
+    leaf = create_folders(drive, "root", "a/b/c", cache=cache)
+    assert drive.calls == {"list": 3, "create": 3}
+
+    drive.calls.clear()
+    assert create_folders(drive, "root", "a/b/c/", cache=cache) == leaf
+    assert create_folders(drive, "root", "a/b/d", cache=cache) != leaf
+    assert drive.calls == {"list": 1, "create": 1}
+
+    # A new process starts with an empty LRU but shares the store.
+    drive.calls.clear()
+    assert create_folders(drive, "root", "a/b/c", cache=DriveFolderCache(store)) == leaf
+    assert drive.calls == {}
+
+
+def test_upload_revalidates_deleted_folder(drive):
+    cache = DriveFolderCache(store=DictStore())
+    create_folders(drive, "root", "a/b", cache=cache)
+    drive.remove(cache.get("root", "a"))
+
+    file_id = upload_file_to_gdrive(
+        drive, "root", "a/b/file.txt", io.BytesIO(b"content"), cache=cache
+    )
+    uploaded = drive.files_by_id[file_id]
+    assert uploaded["content"] == b"content"
+    assert uploaded["parents"] == [cache.get("root", "a/b")]
+    assert drive.files_by_id[cache.get("root", "a/b")]["parents"] == [
+        cache.get("root", "a")
+    ]
+
+
+def test_with_backoff():
+    delays = []
+    calls = iter([HttpError(httplib2.Response({"status": 503}), b""), "done"])
+
+    def call():
+        result = next(calls)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert with_backoff(call, base_delay=2, sleep=delays.append) == "done"
+    assert len(delays) == 1 and 0 <= delays[0] <= 2
+
+    def forbidden():
+        raise HttpError(httplib2.Response({"status": 403}), b"")
+
+    with pytest.raises(HttpError):
+        with_backoff(forbidden, sleep=delays.append)
+    assert len(delays) == 1
+
+
+def test_upload_retries_transient_errors(drive):
+    drive.failures = [429, 500]
+    file_id = upload_file_to_gdrive(drive, "root", "a/file.txt", io.BytesIO(b"data"))
+    assert drive.files_by_id[file_id]["content"] == b"data"
+
+    drive.failures = [503] * (google_drive.RETRIES + 1)
+    with pytest.raises(HttpError):
+        upload_file_to_gdrive(drive, "root", "a/file.txt", io.BytesIO(b"data"))
+
+
+def test_upload_pool(drive):
+    metrics.reset()
+    pool = DriveUploadPool(workers=2)
+    futures = [
+        pool.submit(
+            upload_file_to_gdrive, drive, "root", f"{i}.txt", io.BytesIO(b"x")
+        )
+        for i in range(4)
+    ]
+    futures.append(pool.submit(lambda: 1 / 0))
+    pool.shutdown()
+    assert all(future.result() for future in futures[:4])
+    assert futures[-1].result() is None
+    counts = metrics.snapshot()
+    assert counts["gdrive.uploads.completed"] == 4
+    assert counts["gdrive.uploads.failed"] == 1
+    assert counts["gdrive.upload.bytes"] == 4
+    assert counts["gdrive.uploads.queued"] == counts["gdrive.uploads.active"] == 0
+
+
+def test_upload_pool_busy_time():
+    metrics.reset()
+    pool = DriveUploadPool(workers=2)
+    started = threading.Barrier(2)
+
+    def upload():
+        started.wait()
+        time.sleep(0.2)
+
+    for _ in range(2):
+        pool.submit(upload)
+    pool.shutdown()
+    counts = metrics.snapshot()
+    # The two uploads overlap, so the pool was busy for about one of them.
+    assert counts["gdrive.upload.ms"] >= 400
+    assert 200 <= counts["gdrive.upload.busyMs"] < 350
+
+
+def test_resolve_upload_targets(drive):
+    cache = DriveFolderCache()
+    folder = create_folders(drive, "root", "a", cache=cache)
+    for name in ("x.txt", "y.txt", "z.txt"):
+        upload_file_to_gdrive(drive, "root", f"a/{name}", io.BytesIO(b""))
+    drive.page_size = 2
+    drive.calls.clear()
+
+    paths = ["a/x.txt", "a/z.txt", "a/new.txt", "b/c/new.txt"]
+    targets = resolve_upload_targets(drive, "root", paths, cache=cache)
+    existing = {f["name"]: f["id"] for f in drive.files_by_id.values()}
+    assert targets["a/x.txt"][0] == folder
+    assert targets["a/x.txt"][1]["id"] == existing["x.txt"]
+    assert targets["a/z.txt"][1]["id"] == existing["z.txt"]
+    assert targets["a/new.txt"] == (folder, None)
+    assert targets["b/c/new.txt"] == (cache.get("root", "b/c"), None)
+    # Two pages for "a", one for "b/c", and the lookups of "b" and "c".
+    assert drive.calls == {"list": 5, "create": 2}
+
+
+def test_upload_skips_unchanged_content(drive):
+    metrics.reset()
+    checksums = []
+
+    def checksum(content):
+        def md5():
+            checksums.append(content)
+            return hashlib.md5(content).hexdigest()
+
+        return md5
+
+    def upload(content):
+        return upload_file_to_gdrive(
+            drive, "root", "file.txt", io.BytesIO(content), checksum=checksum(content)
+        )
+
+    file_id = upload(b"data")
+    assert checksums == []
+    assert upload(b"data") == file_id
+    # Same size, other content.
+    assert upload(b"DATA") == file_id
+    assert drive.files_by_id[file_id]["content"] == b"DATA"
+    # Other size, so the checksum is not needed.
+    assert upload(b"longer") == file_id
+    assert checksums == [b"data", b"DATA"]
+    assert drive.calls["create"] == 1 and drive.calls["update"] == 2
+    counts = metrics.snapshot()
+    assert counts["gdrive.uploads.skipped"] == 1
+    assert counts["gdrive.upload.bytesSaved"] == 4
+    assert counts["gdrive.upload.bytes"] == 4 + 4 + 6
+
+
+class FakeCredentials:
+    def __init__(self, expires_in):
+        self.expiry = datetime.datetime.utcnow() + expires_in
+        self.refresh_token = "refresh"
+        self.refreshed = 0
+
+    @property
+    def valid(self):
+        return self.expiry > datetime.datetime.utcnow()
+
+    def refresh(self, request):
+        self.refreshed += 1
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+def test_drive_client(monkeypatch, drive):
+    builds = []
+
+    def build_from_document(document, credentials):
+        builds.append(credentials)
+        return drive
+
+    monkeypatch.setattr(google_drive, "build_from_document", build_from_document)
+    credentials = FakeCredentials(datetime.timedelta(hours=1))
+    client = DriveClient(credentials)
+    assert builds == []
+    try:
+        create_folders(client, "root", "a")
+        create_folders(client, "root", "b")
+        assert builds == [credentials]
+
+        client.refresh()
+        assert credentials.refreshed == 0
+        credentials.expiry = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+        client.refresh()
+        assert credentials.refreshed == 1
+    finally:
+        client.close()
@@ -0,0 +1,45 @@
+import io
+
+import pandas as pd
+
+from ..lib.importer import RowValidator, buffered
+
+
+class ReadOnlyStream:
+    """Mimics a request body, which only supports sequential reads."""
+
+    def __init__(self, data):
+        self._buffer = io.BytesIO(data)
+        self.reads = 0
+
+    def read(self, size=-1):
+        self.reads += 1
+        return self._buffer.read(size)
+
+
+def test_buffered_csv_chunks():
+    body = b"data.sampleId,data.n\n" + b"".join(
+        b"S%d,%d\n" % (i, i) for i in range(10)
+    )
+    stream = ReadOnlyStream(body)
+    chunks = list(pd.read_csv(buffered(stream, buffer_size=16), chunksize=4))
+    assert [len(chunk) for chunk in chunks] == [4, 4, 2]
+    assert chunks[-1]["data.sampleId"].tolist() == ["S8", "S9"]
+    assert stream.reads > 1
+
+
+def test_row_validator_parallel_matches_serial():
+    schema = {
+        "type": "object",
+        "properties": {"n": {"type": "integer", "maximum": 5}},
+        "required": ["n"],
+    }
+    rows = [{"n": i} for i in range(10)] + [{}]
+    serial = RowValidator(schema).validate(rows)
+    with RowValidator(schema, workers=2, min_parallel_rows=1) as validator:
+        parallel = validator.validate(rows)
+        assert validator._pool is not None
+    assert parallel == serial
+    assert serial[:6] == [None] * 6
+    assert serial[6] == "6 is greater than the maximum of 5"
+    assert serial[-1] == "'n' is a required property"
@@ -4,6 +4,8 @@ from ..lib.jq import (
     convert_to_jq_notation,
     find_key_paths,
     get_value,
+    iter_jq_keys,
+    iter_jq_notation,
     parse_jq_notation,
     set_value,
 )
@@ -102,3 +104,25 @@ def test_convert_list_of_lists(list_of_lists_jq, list_of_lists):
 def test_list_of_lists(list_of_lists, list_of_lists_jq):
     result = parse_jq_notation(list_of_lists_jq)
     assert result == list_of_lists
+
+
+def test_iter_jq_notation(jq_result):
+    pairs = iter_jq_notation(jq_result)
+    assert next(pairs) == ("data.key", 1)
+    assert next(pairs) == ("data.list.[0].first_name", "Alan")
+    assert list(iter_jq_notation({"a": {}, "b": [], "c": [[], {"d": 1}]})) == [
+        ("c.[1].d", 1)
+    ]
+    assert list(iter_jq_notation(["x"], "root")) == [("root.[0]", "x")]
+    assert list(iter_jq_notation("x", "root")) == [("root", "x")]
+
+
+def test_iter_jq_notation_deep():
+    data = value = []
+    for _ in range(5000):
+        value.append([])
+        value = value[0]
+    value.append(1)
+    key = "deep" + ".[0]" * 5001
+    assert list(iter_jq_notation({"deep": data})) == [(key, 1)]
+    assert list(iter_jq_keys({"deep": data})) == [key]
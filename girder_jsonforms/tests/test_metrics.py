@@ -0,0 +1,14 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from ..lib.metrics import Metrics
+
+
+def test_metrics():
+    metrics = Metrics()
+    with ThreadPoolExecutor(4) as pool:
+        list(pool.map(lambda _: metrics.incr("b"), range(100)))
+    metrics.incr("a", 3)
+    assert metrics.snapshot() == {"a": 3, "b": 100}
+    assert metrics.get("missing") == 0
+    metrics.reset()
+    assert metrics.snapshot() == {}
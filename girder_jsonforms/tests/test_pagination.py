@@ -0,0 +1,47 @@
+import datetime
+
+import pytest
+from bson import ObjectId
+
+from ..lib.pagination import InvalidPageToken, encode_token, keyset_query, keyset_sort
+
+
+def test_keyset_sort():
+    assert keyset_sort([("created", 1)]) == [("created", 1), ("_id", 1)]
+    assert keyset_sort([("_id", -1)]) == [("_id", -1)]
+    with pytest.raises(InvalidPageToken):
+        keyset_sort([("name", 1), ("created", 1)])
+
+
+def test_keyset_query_roundtrip():
+    doc = {
+        "_id": ObjectId(),
+        "created": datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc),
+    }
+    sort = keyset_sort([("created", 1)])
+    assert keyset_query(encode_token(doc, sort), sort) == {
+        "$or": [
+            {"created": {"$gt": doc["created"]}},
+            {"created": doc["created"], "_id": {"$gt": doc["_id"]}},
+        ]
+    }
+
+
+def test_keyset_query_descending_nested_field():
+    doc = {"_id": ObjectId(), "data": {"sampleId": "S1"}}
+    sort = keyset_sort([("data.sampleId", -1)])
+    assert keyset_query(encode_token(doc, sort), sort) == {
+        "$or": [
+            {"$or": [{"data.sampleId": {"$lt": "S1"}}, {"data.sampleId": None}]},
+            {"data.sampleId": "S1", "_id": {"$lt": doc["_id"]}},
+        ]
+    }
+
+
+def test_keyset_query_invalid_token():
+    sort = keyset_sort([("name", 1)])
+    with pytest.raises(InvalidPageToken):
+        keyset_query("not a token", sort)
+    token = encode_token({"_id": ObjectId(), "created": None}, keyset_sort([("created", 1)]))
+    with pytest.raises(InvalidPageToken):
+        keyset_query(token, sort)
@@ -0,0 +1,40 @@
+import pytest
+
+from ..lib.path_template import (
+    PathTemplateError,
+    compile_path_template,
+    render_path_template,
+)
+
+
+def test_render_path_template():
+    data = {"sampleId": "ab12", "plate": {"row": "c", "col": 3}}
+    template = "{data['sampleId'][:2].upper()}/{ord(data['plate']['row']) - 96}-{data['plate']['col']:02d}"
+    assert render_path_template(template, data) == "AB/3-03"
+    assert compile_path_template(template) is compile_path_template(template)
+
+
+def test_render_path_template_missing_data():
+    assert render_path_template("{data['missing']}", {}) is None
+    assert render_path_template("{data['n'].zfill(3)}", {"n": 5}) is None
+
+
+@pytest.mark.parametrize(
+    "template",
+    [
+        "{open('/etc/passwd')}",
+        "{data.__class__}",
+        "{__import__('os')}",
+        "{[x for x in data]}",
+        "{(lambda: 1)()}",
+        "{data['a'].format(1)}",
+        "{data['a'",
+    ],
+)
+def test_invalid_path_template(template):
+    with pytest.raises(PathTemplateError):
+        compile_path_template(template)
+
+
+def test_render_legacy_path_template():
+    assert render_path_template("{data.get('sampleId')}", {"sampleId": "a"}) is None
@@ -0,0 +1,81 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from ..lib.remote_schema import RemoteSchemaCache
+
+
+class SchemaHandler(BaseHTTPRequestHandler):
+    schema = {"type": "object", "properties": {"sampleId": {"type": "string"}}}
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self):
+        self.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = json.dumps(self.schema).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", self.etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def schema_url():
+    SchemaHandler.requests = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), SchemaHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/schema.json"
+    server.shutdown()
+    server.server_close()
+
+
+def test_fresh_document_is_served_from_cache(schema_url):
+    cache = RemoteSchemaCache()
+    first = cache.fetch(schema_url, ttl=60)
+    second = cache.fetch(schema_url, ttl=60)
+    assert json.loads(first.content) == SchemaHandler.schema
+    assert first is second
+    assert len(SchemaHandler.requests) == 1
+
+
+def test_expired_document_is_revalidated(schema_url):
+    cache = RemoteSchemaCache()
+    first = cache.fetch(schema_url, ttl=0, stale_ttl=0)
+    second = cache.fetch(schema_url, ttl=0, stale_ttl=0)
+    assert first.version == second.version
+    assert len(SchemaHandler.requests) == 2
+    assert SchemaHandler.requests[1]["If-None-Match"] == '"v1"'
+
+
+def test_stale_document_is_revalidated_in_background(schema_url):
+    cache = RemoteSchemaCache()
+    first = cache.fetch(schema_url, ttl=0, stale_ttl=60)
+    fetched = first.fetched
+    assert cache.fetch(schema_url, ttl=0, stale_ttl=60) is first
+    for _ in range(50):
+        if first.fetched != fetched:
+            break
+        time.sleep(0.01)
+    assert len(SchemaHandler.requests) == 2
+    assert first.fetched > fetched
+
+
+def test_unreachable_url_serves_last_copy(schema_url):
+    cache = RemoteSchemaCache()
+    first = cache.fetch(schema_url)
+    first.fetched -= 3600
+    cache._documents["http://127.0.0.1:1/schema.json"] = first
+    assert cache.fetch("http://127.0.0.1:1/schema.json", ttl=0, stale_ttl=0) is first
@@ -28,6 +28,7 @@ setup(
         "girder>=5.0.0a5.dev0",
         "google-api-python-client",
         "google-auth-oauthlib",
+        "openpyxl",
         "pandas",
     ],
     entry_points={"girder.plugin": ["jsonforms = girder_jsonforms:JSONFormsPlugin"]},